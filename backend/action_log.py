@@ -0,0 +1,157 @@
+"""
+Write-behind log for the actions table.
+
+Endpoints call log_action(), which only puts the event on an in-process
+queue. A daemon thread writes queued events with a single COPY once
+ACTION_LOG_BATCH_SIZE events are waiting or ACTION_LOG_FLUSH_INTERVAL
+seconds have passed, and whatever is left is flushed at interpreter exit.
+Events are timestamped when they are logged, not when they are written.
+"""
+
+import atexit
+import csv
+import io
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from db import execute_query, get_db_connection, release_db_connection
+
+logger = logging.getLogger(__name__)
+
+ACTION_LOG_BATCH_SIZE = int(os.getenv('ACTION_LOG_BATCH_SIZE', '200'))
+ACTION_LOG_FLUSH_INTERVAL = float(os.getenv('ACTION_LOG_FLUSH_INTERVAL', '1.0'))
+ACTION_LOG_MAX_QUEUE = int(os.getenv('ACTION_LOG_MAX_QUEUE', '10000'))
+
+COPY_SQL = "COPY actions (user_id, action, metadata, created_at) FROM STDIN WITH (FORMAT csv)"
+
+_STOP = object()
+
+
+class ActionLogWriter:
+    """
+    Buffered writer for action events.
+
+    Args:
+        batch_size: Flush as soon as this many events are queued
+        flush_interval: Flush at least this often (seconds) while events are queued
+        max_queue: Events beyond this are dropped rather than blocking the caller
+    """
+
+    def __init__(self, batch_size=ACTION_LOG_BATCH_SIZE, flush_interval=ACTION_LOG_FLUSH_INTERVAL,
+                 max_queue=ACTION_LOG_MAX_QUEUE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.written = 0
+        self._thread = threading.Thread(target=self._run, name='action-log-writer', daemon=True)
+        self._thread.start()
+
+    def log(self, user_id, action, metadata=None):
+        """Queue one event; never blocks and never raises on a full queue."""
+        event = (str(user_id), action, json.dumps(metadata) if metadata is not None else None,
+                 datetime.now(timezone.utc).isoformat())
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning(f"Action log queue full, dropped {action} event")
+
+    def close(self, timeout=10):
+        """Flush everything queued so far and stop the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = None
+        stopping = False
+        while not stopping:
+            # Sleep until the next event, or until the oldest queued event is due
+            timeout = max(0, deadline - time.monotonic()) if batch else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                stopping = True
+            elif item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+
+            if batch and (stopping or len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+
+    def _flush(self, batch):
+        try:
+            self._copy(batch)
+            self.written += len(batch)
+        except Exception as e:
+            # One bad row (e.g. an unknown user_id) fails the whole COPY;
+            # fall back to row by row so the rest of the batch survives.
+            logger.warning(f"COPY of {len(batch)} actions failed, inserting one by one: {str(e)}")
+            for event in batch:
+                try:
+                    execute_query(
+                        "INSERT INTO actions (user_id, action, metadata, created_at) VALUES (%s, %s, %s, %s)",
+                        event
+                    )
+                    self.written += 1
+                except Exception as row_error:
+                    self.dropped += 1
+                    logger.error(f"Error writing {event[1]} action for {event[0]}: {str(row_error)}")
+
+    def _copy(self, batch):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for user_id, action, metadata, created_at in batch:
+            # csv writes None as an empty unquoted field, which COPY reads as NULL
+            writer.writerow((user_id, action, metadata, created_at))
+        buffer.seek(0)
+
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.copy_expert(COPY_SQL, buffer)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            release_db_connection(conn)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """Get the process-wide ActionLogWriter, starting it on first use."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = ActionLogWriter()
+                atexit.register(_writer.close)
+    return _writer
+
+
+def log_action(user_id, action, metadata=None):
+    """
+    Record a user action without waiting for the database.
+
+    Args:
+        user_id: The user's ID
+        action: Action name, e.g. 'download_image'
+        metadata: JSON-serializable dict stored in actions.metadata
+    """
+    get_writer().log(user_id, action, metadata)
@@ -0,0 +1,158 @@
+"""
+Admission control for /api/create based on live queue depth.
+
+Queue depth (jobs waiting to be generated) comes from the per-state counters
+kept by the database (see job_states.py), so it costs the same however long
+the queue gets. Worker throughput (jobs completed per second over the last
+ADMISSION_THROUGHPUT_WINDOW seconds) is read alongside it. Both are cached
+for ADMISSION_STATS_TTL seconds, so bursts of uploads don't each query them.
+A new request is rejected when it would push the backlog past
+ADMISSION_MAX_BACKLOG jobs or the estimated wait past ADMISSION_MAX_WAIT
+seconds.
+
+Completions only show how much work arrived, not how much the workers can
+do, so a quiet system would look slow. Waits are therefore estimated from
+ADMISSION_WORKER_CAPACITY when it is set, and otherwise from the measured
+rate but never less than ADMISSION_DEFAULT_THROUGHPUT. Requests are always
+admitted while nothing is queued or running.
+
+Full-resolution upgrades of previews (see quality.py) are counted apart:
+they only run when the workers have nothing new to do, so they never hold
+back new uploads.
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+from collections import namedtuple
+
+from db import execute_query
+import job_states
+from quality import PRIORITY_NEW
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_MAX_BACKLOG = int(os.getenv('ADMISSION_MAX_BACKLOG', '600'))
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', '300'))
+ADMISSION_THROUGHPUT_WINDOW = int(os.getenv('ADMISSION_THROUGHPUT_WINDOW', '300'))
+ADMISSION_STATS_TTL = float(os.getenv('ADMISSION_STATS_TTL', '2'))
+# Jobs per second the workers are assumed to manage at least.
+ADMISSION_DEFAULT_THROUGHPUT = float(os.getenv('ADMISSION_DEFAULT_THROUGHPUT', '0.5'))
+# Jobs per second all workers together can process; 0 estimates it from completions.
+ADMISSION_WORKER_CAPACITY = float(os.getenv('ADMISSION_WORKER_CAPACITY', '0'))
+
+QUEUED_STATUSES = job_states.QUEUED
+
+QueueStats = namedtuple('QueueStats', ['depth', 'in_progress', 'throughput', 'measured', 'upgrades', 'states'])
+
+Decision = namedtuple('Decision', ['admitted', 'estimated_wait', 'retry_after', 'headroom'])
+
+_cached = None
+_cached_at = 0.0
+_lock = threading.Lock()
+
+
+def _measure():
+    state_counts = job_states.counts()
+    depth = upgrades = in_progress = 0
+    for (status, priority), count in state_counts.items():
+        if status in QUEUED_STATUSES:
+            if priority == PRIORITY_NEW:
+                depth += count
+            else:
+                upgrades += count
+        elif status == job_states.PROCESSING:
+            in_progress += count
+
+    query = "SELECT COUNT(*) FROM image_requests WHERE completed_at > NOW() - make_interval(secs => %s)"
+    completed = execute_query(query, (ADMISSION_THROUGHPUT_WINDOW,))[0][0]
+    measured = completed > 0
+    if ADMISSION_WORKER_CAPACITY > 0:
+        throughput = ADMISSION_WORKER_CAPACITY
+    else:
+        throughput = max(completed / ADMISSION_THROUGHPUT_WINDOW, ADMISSION_DEFAULT_THROUGHPUT)
+    return QueueStats(depth, in_progress, throughput, measured, upgrades, job_states.totals(state_counts))
+
+
+def get_queue_stats():
+    """
+    Get the current queue depth and worker throughput.
+
+    Returns:
+        QueueStats: At most ADMISSION_STATS_TTL seconds old
+    """
+    global _cached, _cached_at
+    if _cached is not None and time.monotonic() - _cached_at < ADMISSION_STATS_TTL:
+        return _cached
+    with _lock:
+        if _cached is None or time.monotonic() - _cached_at >= ADMISSION_STATS_TTL:
+            _cached = _measure()
+            _cached_at = time.monotonic()
+        return _cached
+
+
+def estimate_wait(stats, extra_jobs=0):
+    """Seconds until extra_jobs more jobs would be done at the measured throughput."""
+    return (stats.depth + stats.in_progress + extra_jobs) / max(stats.throughput, 1e-6)
+
+
+def check(new_jobs):
+    """
+    Decide whether to accept new_jobs more jobs.
+
+    Returns:
+        Decision: admitted flag, estimated wait for the new jobs, seconds the
+        client should wait before retrying when rejected, and the number of
+        jobs that could still be accepted right now
+    """
+    stats = get_queue_stats()
+    estimated_wait = estimate_wait(stats, new_jobs)
+    headroom = max(0, min(
+        ADMISSION_MAX_BACKLOG - stats.depth,
+        int(ADMISSION_MAX_WAIT * stats.throughput) - stats.depth - stats.in_progress
+    ))
+    # An idle queue can always take a request, whatever the estimate says
+    if new_jobs <= headroom or stats.depth + stats.in_progress == 0:
+        return Decision(True, estimated_wait, 0, headroom)
+
+    # Time for the workers to drain enough of the backlog to fit this request
+    excess = new_jobs - headroom
+    retry_after = max(1, math.ceil(excess / max(stats.throughput, 1e-6)))
+    logger.warning(f"Rejecting {new_jobs} jobs: backlog {stats.depth}, throughput {stats.throughput:.2f}/s")
+    return Decision(False, estimated_wait, retry_after, headroom)
+
+
+def record_admitted(new_jobs):
+    """Count freshly queued jobs into the cached depth until the next measurement."""
+    global _cached
+    with _lock:
+        if _cached is not None:
+            _cached = _cached._replace(depth=_cached.depth + new_jobs)
+
+
+def record_cancelled(jobs):
+    """Take cancelled jobs out of the cached depth until the next measurement."""
+    global _cached
+    with _lock:
+        if _cached is not None:
+            _cached = _cached._replace(depth=max(0, _cached.depth - jobs))
+
+
+def status():
+    """Queue depth, throughput and headroom for dashboards and clients."""
+    stats = get_queue_stats()
+    decision = check(0)
+    return {
+        'queue_depth': stats.depth,
+        'in_progress': stats.in_progress,
+        'upgrades_pending': stats.upgrades,
+        'throughput_per_second': round(stats.throughput, 3),
+        'throughput_measured': stats.measured,
+        'estimated_wait_seconds': round(estimate_wait(stats), 1),
+        'headroom_jobs': decision.headroom,
+        'max_backlog': ADMISSION_MAX_BACKLOG,
+        'max_wait_seconds': ADMISSION_MAX_WAIT,
+        'jobs_by_status': {state: stats.states.get(state, 0) for state in job_states.STATES},
+    }
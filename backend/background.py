@@ -2,104 +2,129 @@
 """
 Background Processing Script for Image Requests
 
-This script continually polls the image_requests table for entries with 'new' or 'retry' status,
-then processes each request in a separate thread.
+This script continually polls the image_requests table for entries with 'new' or 'retry' status
+on the 'test' queue, then processes each request in a separate thread. It stores a copy of an
+existing image instead of generating one, so it never takes jobs of process_images.py.
+Status changes go through job_states.
 """
         
 import logging
+import os
 import threading
-import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from db import execute_query
+from db import execute_query, reset_primary_pin, use_primary, connection_scope, prewarm_pools
 from dotenv import load_dotenv
+from log_config import configure_logging, set_request_id
+from profiling import profile_job, install_signal_handler
+from cancellation import JobCancelled, ensure_not_cancelled
+import job_states
+import quality
 import json
 # Load environment variables
 load_dotenv()
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
-logger = logging.getLogger(__name__)
+configure_logging()
+# Named explicitly: run as a script, __name__ is '__main__' and LOG_SAMPLE_RATES would not match
+logger = logging.getLogger('background')
 
-def get_pending_requests():
-    """Get all image requests with 'new' or 'retry' status."""
+# Scheduling knobs; simulate.py sweeps them against a fake generation backend.
+BACKGROUND_POLL_INTERVAL = float(os.getenv('BACKGROUND_POLL_INTERVAL', '5'))
+BACKGROUND_ERROR_SLEEP = float(os.getenv('BACKGROUND_ERROR_SLEEP', '30'))
+# 0 fetches every waiting request per poll
+BACKGROUND_BATCH_SIZE = int(os.getenv('BACKGROUND_BATCH_SIZE', '0'))
+# 0 starts one thread per request of the batch
+BACKGROUND_CONCURRENCY = int(os.getenv('BACKGROUND_CONCURRENCY', '0'))
+
+def get_pending_requests(limit=BACKGROUND_BATCH_SIZE):
+    """Get image requests with 'new' or 'retry' status, at most limit of them if limit > 0."""
     logger.debug("Querying database for pending requests")
     query = """
         SELECT ir.id, ir.request_id, ir.result_image_id, ir.user_id, ir.theme_id
         FROM image_requests ir
-        WHERE ir.status IN ('new', 'retry')
-        ORDER BY ir.created_at
+        WHERE ir.queue = %s AND ir.status = ANY(%s)
+        ORDER BY ir.priority, ir.created_at
+        LIMIT %s
     """
-    results = execute_query(query)
+    # Replicas may lag behind jobs other workers already picked up.
+    with use_primary():
+        # LIMIT NULL is no limit
+        results = execute_query(query, (job_states.TEST, list(job_states.QUEUED), limit if limit > 0 else None))
     logger.debug(f"Found {len(results) if results else 0} pending requests")
     return results
 
+def fetch_test_image():
+    """
+    Get an existing image from the database to use as test data.
+    
+    Returns:
+        tuple: (data, mime_type)
+    """
+    fetch_query = "SELECT data, mime_type FROM images LIMIT 1"
+    image_result = execute_query(fetch_query)
+    
+    if not image_result:
+        logger.error(f"Test image not found in database")
+        raise Exception(f"Test image not found in database")
+    
+    return image_result[0][0], image_result[0][1]
+
+@profile_job('background')
+@connection_scope()
 def process_request_test(request_id, result_image_id, user_id, theme_id):
     """Process a single image request in a separate thread."""
+    set_request_id(request_id)
+    reset_primary_pin()
     try:
         logger.info(f"Processing request {request_id} with result image {result_image_id}")
         
-        # Update status to pending
-        logger.debug(f"Updating request {request_id} status to 'pending'")
-        query = "UPDATE image_requests SET status = 'pending' WHERE result_image_id = %s"
-        execute_query(query, (result_image_id,))
+        # Claim the request, unless it was cancelled or claimed elsewhere since it was listed
+        logger.debug(f"Updating request {request_id} status to '{job_states.PROCESSING}'")
+        if not job_states.claim(result_image_id):
+            logger.info(f"Skipping result {result_image_id}, it was cancelled or claimed elsewhere")
+            return
         
-        # Create a real image in the images table
-        logger.debug(f"Preparing to insert image for request {request_id}")
-        query = """
-            INSERT INTO images (id, user_id, data, mime_type, metadata) 
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (id) DO UPDATE 
-            SET data = EXCLUDED.data, 
-                mime_type = EXCLUDED.mime_type,
-                metadata = EXCLUDED.metadata
-        """
-
         # Get an existing image from the database to use as test data
         logger.debug(f"Fetching existing test image from database for request {request_id}")
-        fetch_query = "SELECT data, mime_type FROM images LIMIT 1"
-        image_result = execute_query(fetch_query)
-        
-        if not image_result:
-            logger.error(f"Test image not found in database")
-            raise Exception(f"Test image not found in database")
-            
-        real_image_data = image_result[0][0]
-        mime_type = image_result[0][1]
+        real_image_data, mime_type = fetch_test_image()
         logger.debug(f"Using existing image, size: {len(real_image_data)} bytes")
         
-        # Insert the image
+        ensure_not_cancelled(result_image_id)
+        
+        # Insert the image and mark the request ready in one statement
         metadata = {"theme_id": theme_id, "process_method": "test_existing_image"}
         logger.debug(f"Inserting image into database for request {request_id}")
         metadata_json = json.dumps(metadata)
-        execute_query(
-            query, 
-            (result_image_id, user_id, real_image_data, mime_type, metadata_json)
-        )
-        
-        # Update the request status to ready
-        logger.debug(f"Updating request {request_id} status to 'ready'")
-        query = "UPDATE image_requests SET status = 'ready' WHERE result_image_id = %s"
-        execute_query(query, (result_image_id,))
+        if not job_states.finish(result_image_id, real_image_data, mime_type, quality.FULL, metadata_json):
+            logger.info(f"Dropped result {result_image_id}, it was cancelled while processing")
+            return
         
         logger.info(f"Successfully processed request {request_id} with result image {result_image_id}")
         
+    except JobCancelled:
+        logger.info(f"Abandoned cancelled request {request_id} with result image {result_image_id}")
+        
     except Exception as e:
         logger.error(f"Error processing request {request_id}: {str(e)}")
         logger.debug(f"Stack trace for request {request_id}:", exc_info=True)
         
-        # Update the request status to retry
-        logger.debug(f"Setting request {request_id} status to 'retry'")
-        query = "UPDATE image_requests SET status = 'retry' WHERE result_image_id = %s"
-        execute_query(query, (result_image_id,))
+        # Retry the request, or give up after JOB_MAX_ATTEMPTS
+        status = job_states.fail(result_image_id)
+        logger.debug(f"Set request {request_id} status to '{status}'")
 
-def request_processor(requests):
-    """Process multiple requests, each in its own thread."""
+def request_processor(requests, concurrency=BACKGROUND_CONCURRENCY):
+    """Process multiple requests, each in its own thread, or on a pool of concurrency threads if > 0."""
     logger.debug(f"Starting to process {len(requests)} requests")
+    if concurrency > 0:
+        with ThreadPoolExecutor(concurrency, thread_name_prefix='background') as executor:
+            for request in requests:
+                id, request_id, result_image_id, user_id, theme_id = request
+                executor.submit(process_request_test, request_id, result_image_id, user_id, theme_id)
+        logger.debug("All processing threads completed")
+        return
+    
     threads = []
     
     for request in requests:
@@ -120,15 +145,24 @@ def request_processor(requests):
         thread.join()
     logger.debug("All processing threads completed")
 
-def main():
-    """Main background process loop."""
-    logger.info("Starting background image request processor")
+def run_worker(batch_size=BACKGROUND_BATCH_SIZE, poll_interval=BACKGROUND_POLL_INTERVAL,
+               error_sleep=BACKGROUND_ERROR_SLEEP, concurrency=BACKGROUND_CONCURRENCY, stop_event=None):
+    """
+    Poll for new and retried requests and process them.
     
-    while True:
+    Args:
+        batch_size: Requests fetched per poll, 0 for all of them
+        poll_interval: Seconds to sleep after every poll
+        error_sleep: Seconds to sleep after an error in the loop itself
+        concurrency: Threads per batch, 0 for one per request
+        stop_event: threading.Event ending the loop once set; runs forever if None
+    """
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
         try:
             # Get pending requests
             logger.debug("Checking for pending requests")
-            pending_requests = get_pending_requests()
+            pending_requests = get_pending_requests(batch_size)
             
             if pending_requests:
                 logger.info(f"Found {len(pending_requests)} pending requests")
@@ -137,7 +171,7 @@ def main():
                 logger.debug("Starting processor thread for batch of requests")
                 processor_thread = threading.Thread(
                     target=request_processor,
-                    args=(pending_requests,)
+                    args=(pending_requests, concurrency)
                 )
                 processor_thread.start()
                 processor_thread.join()
@@ -146,14 +180,24 @@ def main():
                 logger.info("No pending requests found, sleeping...")
             
             # Sleep before checking again
-            logger.debug("Sleeping for 5 seconds before next check")
-            time.sleep(5)
+            logger.debug(f"Sleeping for {poll_interval} seconds before next check")
+            stop_event.wait(poll_interval)
                 
         except Exception as e:
             logger.error(f"Error in main background loop: {str(e)}")
             logger.debug("Stack trace for main loop error:", exc_info=True)
-            logger.info("Sleeping for 30 seconds after error")
-            time.sleep(30)  # Sleep longer if there was an error
+            logger.info(f"Sleeping for {error_sleep} seconds after error")
+            stop_event.wait(error_sleep)  # Sleep longer if there was an error
+
+def main():
+    """Main background process loop."""
+    logger.info("Starting background image request processor")
+    install_signal_handler()
+    try:
+        prewarm_pools()
+    except Exception as e:
+        logger.error(f"Error prewarming database connections: {str(e)}")
+    run_worker()
 
 if __name__ == "__main__":
     main()
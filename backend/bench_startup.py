@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Startup-Time Benchmark for the Web App
+
+Starts fresh interpreters that import main and poll /api/ready through the
+Flask test client, and reports for each run:
+
+- spawn_ms: interpreter start until main begins importing
+- import_ms: time to import main (what a worker pays before binding its port)
+- ready_ms: time from the start of the import until /api/ready returns 200
+  (pool pre-warming and catalog load; needs the database from .env)
+- first_query_ms: a GET /api/queue right after readiness, which hits the database
+
+It also lists the slowest imports of the first run (python -X importtime),
+so heavy dependencies creeping back into module scope stand out.
+
+Usage:
+    python bench_startup.py [--runs 5] [--timeout 30] [--top 15]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+MARKER = 'BENCH '
+
+CHILD = r'''
+import json, sys, time
+spawn_ms = (time.time() - float(sys.argv[1])) * 1000
+started = time.perf_counter()
+import main
+import_ms = (time.perf_counter() - started) * 1000
+client = main.app.test_client()
+ready_ms = None
+deadline = time.perf_counter() + float(sys.argv[2])
+while time.perf_counter() < deadline:
+    if client.get('/api/ready').status_code == 200:
+        ready_ms = (time.perf_counter() - started) * 1000
+        break
+    time.sleep(0.005)
+first_query_ms = None
+if ready_ms is not None:
+    query_started = time.perf_counter()
+    if client.get('/api/queue').status_code == 200:
+        first_query_ms = (time.perf_counter() - query_started) * 1000
+print("BENCH " + json.dumps({
+    'spawn_ms': spawn_ms, 'import_ms': import_ms, 'ready_ms': ready_ms, 'first_query_ms': first_query_ms,
+}), flush=True)
+'''
+
+
+def run_child(timeout, importtime=False):
+    """
+    Run one cold start.
+
+    Returns:
+        tuple: (measurements dict or None, stderr output)
+    """
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', CHILD, repr(time.time()), str(timeout)]
+    result = subprocess.run(command, capture_output=True, text=True, timeout=timeout + 30,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    for line in reversed(result.stdout.splitlines()):
+        if line.startswith(MARKER):
+            return json.loads(line[len(MARKER):]), result.stderr
+    return None, result.stderr
+
+
+def slowest_imports(stderr, top):
+    """Parse -X importtime output into (cumulative ms, module) pairs, slowest first."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, self_us, cumulative_us, name = line.replace('import time:', '|', 1).split('|')
+        # Only top-level and direct imports, nested ones are included in their parent
+        if len(name) - len(name.lstrip()) <= 3:
+            rows.append((int(cumulative_us) / 1000, name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def summarize(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return 'n/a'
+    return f"median {statistics.median(values):8.1f}  min {min(values):8.1f}  max {max(values):8.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold start time of the web app")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=30.0, help="seconds to wait for readiness per run")
+    parser.add_argument('--top', type=int, default=15, help="slowest imports to list; 0 to skip")
+    args = parser.parse_args()
+
+    results = []
+    for n in range(args.runs):
+        measured, stderr = run_child(args.timeout)
+        if measured is None:
+            print(f"Run {n + 1} failed:\n{stderr[-2000:]}", file=sys.stderr)
+            continue
+        results.append(measured)
+
+    if not results:
+        sys.exit(1)
+    print(f"{len(results)} cold starts (ms)")
+    for key in ('spawn_ms', 'import_ms', 'ready_ms', 'first_query_ms'):
+        print(f"  {key:15} {summarize([r[key] for r in results])}")
+    if any(r['ready_ms'] is None for r in results):
+        print(f"  /api/ready did not return 200 within {args.timeout}s in some runs; is the database reachable?")
+
+    if args.top > 0:
+        _, stderr = run_child(args.timeout, importtime=True)
+        print("\nSlowest imports (cumulative ms)")
+        for ms, name in slowest_imports(stderr, args.top):
+            print(f"  {ms:8.1f}  {name}")
+
+
+if __name__ == "__main__":
+    main()
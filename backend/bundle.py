@@ -0,0 +1,126 @@
+"""
+Streaming of every finished result of a request in one response.
+
+All blobs are read with a single query through a server-side cursor, so at
+most a few images are held in memory at a time, and the response body is
+produced chunk by chunk as either multipart/mixed or a stored (uncompressed)
+zip archive.
+"""
+
+import logging
+import mimetypes
+import uuid
+import zipfile
+
+from db import get_db_connection, release_db_connection
+import job_states
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# Rows fetched per round trip from the server-side cursor.
+FETCH_ROWS = 4
+
+READY_STATUSES = (job_states.READY,)
+
+
+def iter_ready_results(request_id, user_id):
+    """
+    Yield (result_image_id, theme_id, mime_type, data) for every finished result,
+    including previews still waiting for their full-resolution pass.
+
+    The connection is held until the generator is exhausted or closed.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor(name=f"bundle_{uuid.uuid4().hex}") as cursor:
+            cursor.itersize = FETCH_ROWS
+            cursor.execute("""
+                SELECT ir.result_image_id, ir.theme_id, i.mime_type, i.data
+                FROM image_requests ir
+                JOIN images i ON i.id = ir.result_image_id
+                WHERE ir.request_id = %s AND ir.user_id = %s
+                  AND (ir.status = ANY(%s) OR ir.stored_tier IS NOT NULL)
+                ORDER BY ir.created_at, ir.result_image_id
+            """, (request_id, user_id, list(READY_STATUSES)))
+            for result_image_id, theme_id, mime_type, data in cursor:
+                yield str(result_image_id), theme_id, mime_type, data
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+
+def _chunks(data):
+    view = memoryview(data)
+    for offset in range(0, len(view), CHUNK_SIZE):
+        yield bytes(view[offset:offset + CHUNK_SIZE])
+
+
+def _filename(result_image_id, mime_type):
+    return f"{result_image_id}{mimetypes.guess_extension(mime_type or '') or '.jpg'}"
+
+
+def stream_multipart(results, boundary):
+    """
+    Encode results as a multipart/mixed body.
+
+    Each part carries the image's Content-Type plus X-Result-Image-Id and
+    X-Theme-Id headers so the client can place it in the grid.
+    """
+    for result_image_id, theme_id, mime_type, data in results:
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Type: {mime_type}\r\n"
+            f"Content-Disposition: attachment; filename=\"{_filename(result_image_id, mime_type)}\"\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"X-Result-Image-Id: {result_image_id}\r\n"
+            f"X-Theme-Id: {theme_id}\r\n\r\n"
+        ).encode()
+        yield from _chunks(data)
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+
+class _ChunkSink:
+    """Write-only file object for zipfile that hands back what was written."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(results):
+    """
+    Encode results as a zip archive without buffering it.
+
+    Entries are stored, not deflated: the images are already compressed.
+    The sink has no tell(), so zipfile writes data descriptors instead of
+    seeking back to patch headers.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED) as archive:
+        for result_image_id, theme_id, mime_type, data in results:
+            info = zipfile.ZipInfo(_filename(result_image_id, mime_type))
+            info.comment = str(theme_id).encode()
+            with archive.open(info, mode='w', force_zip64=len(data) > 0x7FFFFFFF) as entry:
+                for chunk in _chunks(data):
+                    entry.write(chunk)
+                    pending = sink.drain()
+                    if pending:
+                        yield pending
+    # Closing the archive wrote the central directory.
+    yield sink.drain()
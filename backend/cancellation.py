@@ -0,0 +1,80 @@
+"""
+Cancellation of image requests nobody is waiting for anymore.
+
+Cancelling marks every unfinished row of a request 'cancelled'. Queued rows
+are then never claimed, because worker claims only move rows out of their
+expected status. Rows already being processed are abandoned at the next
+stage boundary, where the worker calls ensure_not_cancelled().
+
+Rows that already have a preview stored (see quality.py) only lose their
+full-resolution pass: they become 'ready' with the preview, so it can still
+be viewed and downloaded.
+"""
+
+import logging
+import os
+
+from db import execute_query
+import job_states
+
+logger = logging.getLogger(__name__)
+
+# Cancel a user's unfinished requests when they start a new one.
+AUTO_CANCEL_PREVIOUS = os.getenv('AUTO_CANCEL_PREVIOUS', '1').lower() in ('1', 'true', 'yes')
+
+CANCELLABLE_STATUSES = job_states.UNFINISHED
+
+
+class JobCancelled(Exception):
+    """Raised inside a worker job whose request was cancelled."""
+
+
+def cancel_request(request_id, user_id):
+    """
+    Cancel the unfinished results of one request.
+
+    Returns:
+        int: Number of results cancelled
+    """
+    query = """
+        UPDATE image_requests SET status = CASE WHEN stored_tier IS NULL THEN %s ELSE %s END
+        WHERE request_id = %s AND user_id = %s AND status = ANY(%s)
+    """
+    cancelled = execute_query(
+        query, (job_states.CANCELLED, job_states.READY, request_id, user_id, list(CANCELLABLE_STATUSES))
+    )
+    logger.info(f"Cancelled {cancelled} results of request {request_id}")
+    return cancelled
+
+
+def cancel_previous_requests(user_id, current_request_id):
+    """
+    Cancel the unfinished results of every other request of a user.
+
+    Returns:
+        int: Number of results cancelled
+    """
+    query = """
+        UPDATE image_requests SET status = CASE WHEN stored_tier IS NULL THEN %s ELSE %s END
+        WHERE user_id = %s AND request_id <> %s AND status = ANY(%s)
+    """
+    cancelled = execute_query(
+        query, (job_states.CANCELLED, job_states.READY, user_id, current_request_id, list(CANCELLABLE_STATUSES))
+    )
+    if cancelled:
+        logger.info(f"Cancelled {cancelled} results of earlier requests of user {user_id}")
+    return cancelled
+
+
+def ensure_not_cancelled(result_image_id):
+    """
+    Stage boundary check for workers.
+
+    Raises:
+        JobCancelled: If the result left processing since the job was claimed,
+        i.e. it was cancelled or its full-resolution pass was dropped
+    """
+    query = "SELECT status FROM image_requests WHERE result_image_id = %s"
+    result = execute_query(query, (result_image_id,))
+    if result and result[0][0] != job_states.PROCESSING:
+        raise JobCancelled(f"Result {result_image_id} was cancelled")
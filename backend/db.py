@@ -1,67 +1,327 @@
+import contextlib
+import contextvars
+import itertools
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
 from psycopg2 import pool
-from typing import Optional
 import logging
+from log_config import configure_logging
+from profiling import stage
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
+# Pool sizing. getconn waits up to DB_POOL_TIMEOUT seconds for a free connection.
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "50"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+# Connections idle longer than this are pinged before being handed out.
+DB_POOL_HEALTHCHECK_IDLE = float(os.environ.get("DB_POOL_HEALTHCHECK_IDLE", "30"))
+# Connections per pool opened at startup and then kept open when idle; 0 keeps just DB_POOL_MIN.
+DB_POOL_PREWARM = int(os.environ.get("DB_POOL_PREWARM", "0"))
+# Server-side limit for every statement, 0 disables it.
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", "30000"))
+# The same for maintenance_connection(), e.g. retention and counter rebuilds; 0 disables it.
+DB_MAINTENANCE_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_MAINTENANCE_STATEMENT_TIMEOUT_MS", "0"))
+
+# Optional read replicas, e.g. "replica1:5432,replica2:5432". Plain SELECTs are
+# routed to a replica unless the current request/job has already written.
+DB_REPLICA_HOSTS = os.environ.get("DB_REPLICA_HOSTS", "")
+DB_REPLICA_MAX_LAG = float(os.environ.get("DB_REPLICA_MAX_LAG", "2"))
+DB_REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get("DB_REPLICA_LAG_CHECK_INTERVAL", "5"))
+# How long a client's reads stay on the primary after it wrote. Replicas can be
+# up to DB_REPLICA_MAX_LAG behind, as of a check up to DB_REPLICA_LAG_CHECK_INTERVAL ago.
+DB_STICKY_PRIMARY_SECONDS = float(os.environ.get(
+    "DB_STICKY_PRIMARY_SECONDS", str(DB_REPLICA_MAX_LAG + DB_REPLICA_LAG_CHECK_INTERVAL)
+))
+
+REPLICA_LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+# Set once the current context writes; later reads then go to the primary.
+_primary_pinned = contextvars.ContextVar('primary_pinned', default=False)
+# Wall-clock time of the current context's last write, or None.
+_last_write = contextvars.ContextVar('last_write', default=None)
+# Set inside use_primary() blocks.
+_force_primary = contextvars.ContextVar('force_primary', default=False)
+# Connections held by the current connection_scope(), keyed by pool.
+_scoped_connections = contextvars.ContextVar('scoped_connections', default=None)
+# Statements run through execute_query, for load measurements.
+_query_count = 0
+_query_count_lock = threading.Lock()
+
+def connection_params():
+    """Get database credentials from environment variables."""
+    return {
+        'host': os.environ.get("DB_HOST"),
+        'port': os.environ.get("DB_PORT"),
+        'user': os.environ.get("DB_USER"),
+        'password': os.environ.get("DB_PASSWORD"),
+        'database': os.environ.get("DB_DATABASE"),
+        'options': f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}",
+    }
+
+class BlockingConnectionPool(pool.ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool that waits for a free connection.
+
+    psycopg2's pool raises as soon as maxconn connections are checked out.
+    This one blocks for up to `timeout` seconds first, pings connections that
+    sat idle for a while before handing them out, and records wait times and
+    saturation so the pool can be sized from real numbers.
+    """
+
+    def __init__(self, minconn, maxconn, *args, name='primary', timeout=DB_POOL_TIMEOUT, **kwargs):
+        self.name = name
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._stats_lock = threading.Lock()
+        self._last_used = {}
+        self.acquired = 0
+        self.timeouts = 0
+        self.replaced = 0
+        self.waiting = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def getconn(self, key=None):
+        started = time.monotonic()
+        with self._stats_lock:
+            self.waiting += 1
+        acquired = self._slots.acquire(timeout=self.timeout)
+        waited = time.monotonic() - started
+        with self._stats_lock:
+            self.waiting -= 1
+            if acquired:
+                self.acquired += 1
+                self.in_use += 1
+                self.peak_in_use = max(self.peak_in_use, self.in_use)
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+            else:
+                self.timeouts += 1
+        if not acquired:
+            raise pool.PoolError(f"Timed out after {self.timeout}s waiting for a {self.name} database connection")
+
+        try:
+            conn = super().getconn(key)
+            return self._ensure_healthy(conn)
+        except Exception:
+            self._release_slot()
+            raise
+
+    def _ensure_healthy(self, conn):
+        idle = time.monotonic() - self._last_used.get(id(conn), time.monotonic())
+        if not conn.closed and idle < DB_POOL_HEALTHCHECK_IDLE:
+            return conn
+        try:
+            if conn.closed:
+                raise psycopg2.InterfaceError("connection already closed")
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return conn
+        except psycopg2.Error as e:
+            logger.warning(f"Replacing broken {self.name} database connection: {str(e)}")
+            self._last_used.pop(id(conn), None)
+            super().putconn(conn, close=True)
+            with self._stats_lock:
+                self.replaced += 1
+            return super().getconn()
+
+    def putconn(self, conn, key=None, close=False):
+        try:
+            if close or conn.closed:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            super().putconn(conn, key, close)
+        finally:
+            self._release_slot()
+
+    def prewarm(self, count):
+        """
+        Open connections in parallel until count are available, and keep them.
+
+        psycopg2 closes connections returned beyond minconn, so minconn is
+        raised to count; otherwise the warm connections would be dropped again
+        after their first use.
+
+        Returns:
+            int: Connections opened
+        """
+        count = min(count, self.maxconn)
+        with self._lock:
+            self.minconn = max(self.minconn, count)
+            missing = count - len(self._pool) - len(self._used)
+        if missing <= 0:
+            return 0
+        with ThreadPoolExecutor(min(missing, 8), thread_name_prefix='db-prewarm') as executor:
+            futures = [executor.submit(psycopg2.connect, *self._args, **self._kwargs) for _ in range(missing)]
+        opened = []
+        error = None
+        for future in futures:
+            try:
+                opened.append(future.result())
+            except Exception as e:
+                error = e
+        with self._lock:
+            self._pool.extend(opened)
+        if error is not None:
+            raise error
+        return len(opened)
+
+    def _release_slot(self):
+        with self._stats_lock:
+            self.in_use -= 1
+        self._slots.release()
+
+    def stats(self):
+        """Wait time and saturation counters since the pool was created."""
+        with self._stats_lock:
+            return {
+                'name': self.name,
+                'maxconn': self.maxconn,
+                'in_use': self.in_use,
+                'idle': len(self._pool),
+                'waiting': self.waiting,
+                'saturation': round(self.in_use / self.maxconn, 3),
+                'peak_in_use': self.peak_in_use,
+                'acquired': self.acquired,
+                'timeouts': self.timeouts,
+                'replaced': self.replaced,
+                'avg_wait_ms': round(1000 * self.total_wait / self.acquired, 3) if self.acquired else 0.0,
+                'max_wait_ms': round(1000 * self.max_wait, 3),
+            }
+
 class DatabaseConnection:
     """
     Singleton class for PostgreSQL database connection.
     Manages a connection pool for efficient database access.
     """
     _instance = None
+    _instance_lock = threading.Lock()
     _connection_pool = None
     
     def __new__(cls):
+        # The warm-up thread and the first requests can get here at the same time
         if cls._instance is None:
-            cls._instance = super(DatabaseConnection, cls).__new__(cls)
-            cls._instance._initialize_connection_pool()
+            with cls._instance_lock:
+                if cls._instance is None:
+                    instance = super(DatabaseConnection, cls).__new__(cls)
+                    instance._initialize_connection_pool()
+                    # Published only once its pools exist
+                    cls._instance = instance
         return cls._instance
     
     def _initialize_connection_pool(self):
         """Initialize the connection pool with environment credentials."""
         try:
-            # Get database credentials from environment variables
-            host = os.environ.get("DB_HOST")
-            port = os.environ.get("DB_PORT")
-            user = os.environ.get("DB_USER")
-            password = os.environ.get("DB_PASSWORD")
-            database = os.environ.get("DB_DATABASE")
-            logger.info(f"host: {host}, port: {port}, user: {user}, password: {len(password)*'*'}, database: {database}")
+            params = connection_params()
+            logger.info(f"host: {params['host']}, port: {params['port']}, user: {params['user']}, password: {len(params['password'] or '')*'*'}, database: {params['database']}")
             
             # Connection parameters
-            self._connection_pool = pool.ThreadedConnectionPool(
-                minconn=1,
-                maxconn=50,
-                host=host,
-                port=port,
-                user=user,
-                password=password,
-                database=database
+            self._connection_pool = BlockingConnectionPool(
+                minconn=DB_POOL_MIN,
+                maxconn=DB_POOL_MAX,
+                **params
             )
             # Verify connection works
-            with self.get_connection() as conn:
+            conn = self._connection_pool.getconn()
+            try:
                 with conn.cursor() as cursor:
                     cursor.execute("SELECT 1")
+            finally:
+                self._connection_pool.putconn(conn)
                     
             print("Database connection pool initialized successfully")
+            self._initialize_replicas(params)
             
         except Exception as e:
             print(f"Error initializing database connection pool: {e}")
             self._connection_pool = None
     
-    def get_connection(self):
-        """Get a connection from the pool."""
+    def _initialize_replicas(self, params):
+        """Create one pool per host listed in DB_REPLICA_HOSTS."""
+        self._replicas = []
+        self._replica_cycle = None
+        for entry in filter(None, (h.strip() for h in DB_REPLICA_HOSTS.split(","))):
+            host, _, port = entry.partition(":")
+            replica_params = dict(params, host=host, port=port or params['port'])
+            try:
+                self._replicas.append(Replica(entry, replica_params))
+                logger.info(f"Read replica {entry} added")
+            except Exception as e:
+                logger.error(f"Error connecting to read replica {entry}: {str(e)}")
+        if self._replicas:
+            self._replica_cycle = itertools.cycle(self._replicas)
+
+    def pick_replica(self):
+        """
+        Get the next healthy replica in round-robin order.
+
+        Returns:
+            Replica or None: None when no replica is configured or all lag too far behind
+        """
+        replicas = getattr(self, '_replicas', None)
+        if not replicas:
+            return None
+        for _ in range(len(replicas)):
+            replica = next(self._replica_cycle)
+            if replica.is_healthy():
+                return replica
+        return None
+
+    def replica_status(self):
+        """Lag and health of each configured replica."""
+        return [replica.status() for replica in getattr(self, '_replicas', None) or []]
+
+    def primary_pool(self):
+        """Get the primary pool, initializing it if needed."""
         if self._connection_pool is None:
             self._initialize_connection_pool()
             
         if self._connection_pool is None:
             raise ConnectionError("Failed to establish database connection")
             
-        return self._connection_pool.getconn()
+        return self._connection_pool
+
+    def prewarm(self, count):
+        """
+        Open count connections on the primary pool and on every replica pool.
+
+        Returns:
+            int: Connections opened
+        """
+        opened = self.primary_pool().prewarm(count)
+        for replica in getattr(self, '_replicas', None) or []:
+            try:
+                opened += replica.pool.prewarm(count)
+            except Exception as e:
+                logger.error(f"Error prewarming read replica {replica.name}: {str(e)}")
+        return opened
+
+    def pool_stats(self):
+        """Counters for the primary pool and every replica pool."""
+        pools = [self._connection_pool] if self._connection_pool is not None else []
+        pools += [replica.pool for replica in getattr(self, '_replicas', None) or []]
+        return [p.stats() for p in pools]
+
+    def get_connection(self):
+        """Get a connection from the pool."""
+        return self.primary_pool().getconn()
     
     def release_connection(self, conn):
         """Return a connection to the pool."""
@@ -73,6 +333,59 @@ class DatabaseConnection:
         if self._connection_pool is not None:
             self._connection_pool.closeall()
             self._connection_pool = None
+        for replica in getattr(self, '_replicas', None) or []:
+            replica.pool.closeall()
+        self._replicas = []
+
+
+class Replica:
+    """
+    Connection pool for one read replica plus its last measured lag.
+
+    Lag is re-measured at most every DB_REPLICA_LAG_CHECK_INTERVAL seconds, by
+    whichever caller notices the measurement is stale. A replica that lags more
+    than DB_REPLICA_MAX_LAG seconds, or cannot be reached, is skipped.
+    """
+
+    def __init__(self, name, params):
+        self.name = name
+        self.pool = BlockingConnectionPool(minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, name=f"replica {name}", **params)
+        self.lag = None
+        self.checked_at = 0.0
+        self._check_lock = threading.Lock()
+
+    def is_healthy(self):
+        if time.monotonic() - self.checked_at > DB_REPLICA_LAG_CHECK_INTERVAL:
+            if self._check_lock.acquire(blocking=False):
+                try:
+                    self._check_lag()
+                finally:
+                    self._check_lock.release()
+        return self.lag is not None and self.lag <= DB_REPLICA_MAX_LAG
+
+    def _check_lag(self):
+        conn = None
+        try:
+            conn = self.pool.getconn()
+            with conn.cursor() as cursor:
+                cursor.execute(REPLICA_LAG_QUERY)
+                self.lag = float(cursor.fetchone()[0])
+            conn.rollback()
+            if self.lag > DB_REPLICA_MAX_LAG:
+                logger.warning(f"Replica {self.name} is {self.lag:.1f}s behind, routing reads to primary")
+        except Exception as e:
+            logger.warning(f"Replica {self.name} lag check failed: {str(e)}")
+            self.lag = None
+            if conn is not None:
+                self.pool.putconn(conn, close=True)
+                conn = None
+        finally:
+            self.checked_at = time.monotonic()
+            if conn is not None:
+                self.pool.putconn(conn)
+
+    def status(self):
+        return {'name': self.name, 'lag_seconds': self.lag, 'healthy': self.lag is not None and self.lag <= DB_REPLICA_MAX_LAG}
 
 
 # Convenience functions for accessing the singleton
@@ -85,21 +398,222 @@ def release_db_connection(conn):
     """Release a connection back to the pool."""
     DatabaseConnection().release_connection(conn)
 
-def execute_query(query, params=None):
-    """Execute a query and return results."""
-    conn = None
+@contextlib.contextmanager
+def maintenance_connection(autocommit=False):
+    """
+    Check out a primary connection for long-running maintenance statements.
+
+    For the block, DB_MAINTENANCE_STATEMENT_TIMEOUT_MS replaces the pool's
+    DB_STATEMENT_TIMEOUT_MS, which would cancel full-table work on real data
+    volumes. The caller commits; uncommitted work is rolled back.
+
+    Args:
+        autocommit: Run each statement on its own, for statements that can't
+            run in a transaction block (e.g. DETACH PARTITION ... CONCURRENTLY)
+    """
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
+        conn.autocommit = True
         with conn.cursor() as cursor:
+            cursor.execute("SET statement_timeout = %s", (DB_MAINTENANCE_STATEMENT_TIMEOUT_MS,))
+        conn.autocommit = autocommit
+        yield conn
+    finally:
+        try:
+            if not conn.closed:
+                conn.rollback()
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute("RESET statement_timeout")
+                conn.autocommit = False
+        except psycopg2.Error:
+            conn.close()
+        release_db_connection(conn)
+
+def open_dedicated_connection():
+    """
+    Open a connection outside the pool.
+
+    Used for long-lived sessions such as LISTEN, which would otherwise
+    hold a pooled connection forever. The caller owns and closes it.
+    """
+    return psycopg2.connect(**connection_params())
+
+def open_connection_scope():
+    """
+    Start reusing one connection per pool for every execute_query in this context.
+
+    Connections are checked out lazily on first use and run in autocommit
+    mode, which matches execute_query's commit-per-statement behaviour
+    without the BEGIN/ROLLBACK round trips.
+
+    Returns:
+        contextvars.Token: Pass it to close_connection_scope
+    """
+    return _scoped_connections.set({})
+
+def _return_held(held):
+    for conn_pool, conn in held.items():
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                conn.autocommit = False
+            except psycopg2.Error:
+                broken = True
+        conn_pool.putconn(conn, close=broken)
+    held.clear()
+
+def close_connection_scope(token):
+    """Return every connection held by the scope to its pool."""
+    held = _scoped_connections.get() or {}
+    try:
+        _scoped_connections.reset(token)
+    except ValueError:
+        _scoped_connections.set(None)
+    _return_held(held)
+
+@contextlib.contextmanager
+def outside_connection_scope():
+    """
+    Return the scope's connections to their pools for the duration of the block.
+
+    Wrap outbound HTTP calls with it, so a slow upstream doesn't hold pooled
+    connections that other requests are waiting for. Queries inside the block
+    check out a connection per statement; after it the scope checks out
+    connections again on first use.
+    """
+    held = _scoped_connections.get()
+    if held is not None:
+        _return_held(held)
+    token = _scoped_connections.set(None)
+    try:
+        yield
+    finally:
+        _scoped_connections.reset(token)
+
+@contextlib.contextmanager
+def connection_scope():
+    """
+    Bind one connection per pool to the block.
+
+    Also works as a decorator, e.g. on a worker's per-job function.
+    """
+    token = open_connection_scope()
+    try:
+        yield
+    finally:
+        close_connection_scope(token)
+
+def pool_stats():
+    """Wait time and saturation counters for every pool."""
+    return DatabaseConnection().pool_stats()
+
+def prewarm_pools(count=DB_POOL_PREWARM):
+    """
+    Open the pools' connections before traffic arrives.
+
+    Args:
+        count: Connections per pool; values up to DB_POOL_MIN are already open
+
+    Returns:
+        int: Connections opened
+    """
+    started = time.monotonic()
+    opened = DatabaseConnection().prewarm(max(count, DB_POOL_MIN))
+    if opened:
+        logger.info(f"Opened {opened} database connections in {(time.monotonic() - started) * 1000:.0f} ms")
+    return opened
+
+def query_count():
+    """Number of statements this process has run through execute_query."""
+    return _query_count
+
+def replica_status():
+    """Lag and health of each configured replica."""
+    return DatabaseConnection().replica_status()
+
+def reset_primary_pin(pinned_until=None):
+    """
+    Forget earlier writes; call at the start of each request or job.
+
+    Args:
+        pinned_until: Epoch seconds until which reads should still go to the
+            primary, because the same client wrote shortly before (see
+            primary_pinned_until)
+    """
+    _primary_pinned.set(pinned_until is not None and pinned_until > time.time())
+    _last_write.set(None)
+
+def primary_pinned_until():
+    """
+    Epoch seconds until which the client of this context should read from the
+    primary, or None if the context has not written.
+    """
+    last_write = _last_write.get()
+    return last_write + DB_STICKY_PRIMARY_SECONDS if last_write is not None else None
+
+@contextlib.contextmanager
+def use_primary():
+    """Send every query in this block to the primary."""
+    token = _force_primary.set(True)
+    try:
+        yield
+    finally:
+        _force_primary.reset(token)
+
+def is_read_only(query):
+    """Whether a statement can safely run on a replica."""
+    normalized = query.strip().upper()
+    if not normalized.startswith("SELECT"):
+        return False
+    return " FOR UPDATE" not in normalized and " FOR SHARE" not in normalized
+
+def execute_query(query, params=None, fetch=False):
+    """
+    Execute a query and return results.
+
+    SELECT statements return their rows. Other statements are committed and
+    return the affected row count, or their rows when fetch=True (for
+    statements with RETURNING).
+
+    Read-only statements go to a healthy replica when one is configured,
+    unless this context has already written (read-your-writes).
+    """
+    global _query_count
+    with _query_count_lock:
+        _query_count += 1
+    is_select = query.strip().upper().startswith("SELECT")
+    replica = None
+    if is_select and not _primary_pinned.get() and not _force_primary.get() and is_read_only(query):
+        replica = DatabaseConnection().pick_replica()
+    if not is_select:
+        _primary_pinned.set(True)
+        _last_write.set(time.time())
+
+    conn_pool = replica.pool if replica else DatabaseConnection().primary_pool()
+    held = _scoped_connections.get()
+    conn = held.get(conn_pool) if held is not None else None
+    try:
+        if conn is None:
+            conn = conn_pool.getconn()
+            if held is not None:
+                conn.autocommit = True
+                held[conn_pool] = conn
+        with conn.cursor() as cursor, stage('execute_query'):
             cursor.execute(query, params)
-            if query.strip().upper().startswith("SELECT"):
+            if is_select:
                 return cursor.fetchall()
+            rows = cursor.fetchall() if fetch else None
             conn.commit()
-            return cursor.rowcount
+            return rows if fetch else cursor.rowcount
     except Exception as e:
-        if conn:
+        if conn and not conn.closed:
             conn.rollback()
+        elif conn and held is not None:
+            # Don't keep handing a dead connection to the rest of the scope.
+            held.pop(conn_pool, None)
+            conn_pool.putconn(conn, close=True)
         raise e
     finally:
-        if conn:
-            release_db_connection(conn)
+        if conn and held is None:
+            conn_pool.putconn(conn)
@@ -1,16 +1,19 @@
 import os
 import base64
-import requests
 from io import BytesIO
-from PIL import Image
 import logging
-import openai
-from db import execute_query
+from db import execute_query, outside_connection_scope
+from log_config import configure_logging, DEBUG_PAYLOADS
+from theme_ranking import rank_themes
+from profiling import stage
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
+# openai, PIL and requests are imported by the functions that call them, so
+# importing this module (as every web process does) stays cheap.
+
 theme_descriptions = [
     "Harry Potter: Magical wizarding world with wands, spells, and Hogwarts castle in Studio Ghibli animation style",
     "Star Wars: Futuristic space battles with lightsabers and the Force in Art Deco poster style",
@@ -45,82 +48,127 @@ theme_descriptions = [
 ]
 
 
-def process_image_with_theme(image_file, user_description, theme_description):
+def get_openai_client():
+    """Create an OpenAI client from OPENAI_API_KEY."""
+    # Check if OpenAI API key is configured
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY environment variable not set")
+    
+    import openai
+    return openai.OpenAI(api_key=api_key)
+
+def describe_image(image_file, user_description, client=None):
     """
-    Process an image with OpenAI APIs:
-    1. First get a description of the image using Vision API
-    2. Then generate a new image based on the description and theme
+    Get a detailed description of an image from the OpenAI Vision API.
     
     Args:
         image_file: The input image file object
         user_description: User's description of the image
-        theme_description: Description of the theme to apply
+        client: Optional OpenAI client to reuse
         
     Returns:
-        BytesIO: A file-like object containing the generated image
+        str: The AI description of the image
     """
+    from PIL import Image
+    
     try:
-        # Check if OpenAI API key is configured
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY environment variable not set")
-        
-        # Configure OpenAI client
-        client = openai.OpenAI(api_key=api_key)
+        client = client or get_openai_client()
         
         # Convert image to base64 for API
-        img = Image.open(image_file)
-        buffered = BytesIO()
-        img.save(buffered, format=img.format or "JPEG")
-        encoded_image = base64.b64encode(buffered.getvalue()).decode("utf-8")
+        with stage('encode_image'):
+            img = Image.open(image_file)
+            buffered = BytesIO()
+            img.save(buffered, format=img.format or "JPEG")
+            encoded_image = base64.b64encode(buffered.getvalue()).decode("utf-8")
         
-        # Step 1: Get description from OpenAI Vision API
+        # Get description from OpenAI Vision API
         logger.info("Requesting image description from OpenAI")
-        vision_response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": f"Describe this image in detail. User says it is: {user_description}"
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/{img.format.lower() if img.format else 'jpeg'};base64,{encoded_image}"
+        with stage('openai_vision'), outside_connection_scope():
+            vision_response = client.chat.completions.create(
+                model="gpt-4.1-mini",
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": f"Describe this image in detail. User says it is: {user_description}"
+                            },
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": f"data:image/{img.format.lower() if img.format else 'jpeg'};base64,{encoded_image}"
+                                }
                             }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=500
-        )
+                        ]
+                    }
+                ],
+                max_tokens=500
+            )
         
         # Extract the description
         ai_description = vision_response.choices[0].message.content
         logger.info(f"Received AI description: {ai_description[:100]}...")
+        return ai_description
+        
+    except Exception as e:
+        logger.error(f"Error in describe_image: {str(e)}")
+        raise
+
+def process_image_with_theme(image_file, user_description, theme_description, ai_description=None,
+                             model="dall-e-3", size="1024x1024", max_prompt=4000):
+    """
+    Process an image with OpenAI APIs:
+    1. First get a description of the image using Vision API
+    2. Then generate a new image based on the description and theme
+    
+    Args:
+        image_file: The input image file object
+        user_description: User's description of the image
+        theme_description: Description of the theme to apply
+        ai_description: Description from an earlier Vision API call; skips step 1
+        model: Image generation model
+        size: Size of the generated image
+        max_prompt: Prompt length limit of the model; the description is shortened to fit
+        
+    Returns:
+        BytesIO: A file-like object containing the generated image
+    """
+    import requests
+    
+    try:
+        client = get_openai_client()
+        
+        # Step 1: Get description from OpenAI Vision API
+        if ai_description is None:
+            ai_description = describe_image(image_file, user_description, client)
         
         # Step 2: Generate new image based on description and theme
         # Combine AI description with theme
         generation_prompt = f"Create an image based on this description: {ai_description}. Style it with this theme: {theme_description}"
+        if len(generation_prompt) > max_prompt:
+            # Shorten the description rather than cutting off the theme
+            ai_description = ai_description[:max(0, len(ai_description) - (len(generation_prompt) - max_prompt))]
+            generation_prompt = f"Create an image based on this description: {ai_description}. Style it with this theme: {theme_description}"
         
-        logger.info("Requesting image generation from OpenAI")
-        dalle_response = client.images.generate(
-            model="dall-e-3",
-            prompt=generation_prompt,
-            n=1,
-            size="1024x1024"
-        )
+        logger.info(f"Requesting image generation from OpenAI ({model}, {size})")
+        with stage('openai_generate'), outside_connection_scope():
+            dalle_response = client.images.generate(
+                model=model,
+                prompt=generation_prompt,
+                n=1,
+                size=size
+            )
         
         # Get the generated image URL
         image_url = dalle_response.data[0].url
         
         # Download the generated image
         logger.info("Downloading generated image")
-        image_response = requests.get(image_url)
-        image_response.raise_for_status()
+        with stage('download_result'), outside_connection_scope():
+            image_response = requests.get(image_url)
+            image_response.raise_for_status()
         
         # Return image as BytesIO object
         result = BytesIO(image_response.content)
@@ -150,7 +198,8 @@ def use_credits(user_id, credits):
             logger.error(f"User with ID {user_id} not found")
             return False
         
-        logger.info(f"use_credits db result: {result}")
+        if DEBUG_PAYLOADS:
+            logger.debug(f"use_credits db result: {result}")
             
         current_credits = result[0][0]
         
@@ -190,7 +239,8 @@ def init_user(user_id):
         # Insert new user with 10 credits
         query = "INSERT INTO users (user_id, credits) VALUES (%s, %s) RETURNING user_id, credits"
         result = execute_query(query, (user_id, 10))
-        logger.info(f"init_user db result: {result}")
+        if DEBUG_PAYLOADS:
+            logger.debug(f"init_user db result: {result}")
         
         if result == 1:
             logger.info(f"Created new user {user_id} with 10 credits")
@@ -205,24 +255,20 @@ def init_user(user_id):
 
 def get_themes(user_id, num):
     """
-    Get a specified number of theme IDs from the database.
+    Get a selection of theme IDs for a user, favouring themes they download
+    (see theme_ranking.py).
     
     Args:
-        user_id: The user's ID (not used currently)
+        user_id: The user's ID
         num: Number of theme IDs to return
         
     Returns:
-        list: List of theme IDs from the database
+        list: List of distinct theme IDs
     """
     try:
-        # Query to get theme IDs from the database
-        query = "SELECT id FROM themes ORDER BY created_at DESC LIMIT %s"
-        result = execute_query(query, (num,))
-        
-        # Extract IDs from result
-        theme_ids = [row[0] for row in result] if result else []
+        theme_ids = rank_themes(user_id, num)
         
-        logger.info(f"Retrieved {len(theme_ids)} theme IDs from database")
+        logger.info(f"Selected {len(theme_ids)} theme IDs from catalog")
         return theme_ids
     except Exception as e:
         logger.error(f"Error in get_themes: {str(e)}")
@@ -0,0 +1,80 @@
+"""
+Idempotency keys for /api/create.
+
+The client-supplied request_id is the key. The first call claims it with an
+INSERT guarded by the primary key of create_requests, so concurrent
+duplicates cannot both win. The winner stores its JSON response when done;
+repeats within IDEMPOTENCY_WINDOW seconds get that response back without
+touching image storage or the queue.
+"""
+
+import json
+import logging
+import os
+from collections import namedtuple
+
+from db import execute_query
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_WINDOW = int(os.getenv('IDEMPOTENCY_WINDOW', '86400'))
+# A claim without a response this old belongs to a request that died midway.
+IDEMPOTENCY_INFLIGHT_TIMEOUT = int(os.getenv('IDEMPOTENCY_INFLIGHT_TIMEOUT', '120'))
+
+Claim = namedtuple('Claim', ['claimed', 'user_id', 'response'])
+
+
+def claim(request_id, user_id):
+    """
+    Try to claim request_id for this create call.
+
+    Keys older than IDEMPOTENCY_WINDOW, and abandoned in-flight claims, are
+    taken over.
+
+    Returns:
+        Claim: claimed=True if the caller should do the work; otherwise the
+        owner's user_id and stored response (None while still in flight)
+    """
+    query = """
+        INSERT INTO create_requests (request_id, user_id)
+        VALUES (%s, %s)
+        ON CONFLICT (request_id) DO UPDATE
+        SET user_id = EXCLUDED.user_id, response = NULL, created_at = NOW()
+        WHERE create_requests.created_at < NOW() - make_interval(secs => %s)
+           OR (create_requests.response IS NULL
+               AND create_requests.created_at < NOW() - make_interval(secs => %s))
+        RETURNING request_id
+    """
+    if execute_query(query, (request_id, user_id, IDEMPOTENCY_WINDOW, IDEMPOTENCY_INFLIGHT_TIMEOUT), fetch=True):
+        return Claim(True, str(user_id), None)
+
+    query = "SELECT user_id, response FROM create_requests WHERE request_id = %s"
+    result = execute_query(query, (request_id,))
+    if not result:
+        # Released between our INSERT and SELECT; let the client retry.
+        return Claim(False, None, None)
+    owner, response = result[0]
+    return Claim(False, str(owner), response)
+
+
+def save_response(request_id, response):
+    """Store the response returned for a claimed request_id."""
+    query = "UPDATE create_requests SET response = %s WHERE request_id = %s"
+    execute_query(query, (json.dumps(response), request_id))
+
+
+def release(request_id):
+    """Drop an unfinished claim so a retry can start over."""
+    query = "DELETE FROM create_requests WHERE request_id = %s AND response IS NULL"
+    execute_query(query, (request_id,))
+
+
+def purge_expired():
+    """
+    Delete keys older than IDEMPOTENCY_WINDOW.
+
+    Returns:
+        int: Number of keys deleted
+    """
+    query = "DELETE FROM create_requests WHERE created_at < NOW() - make_interval(secs => %s)"
+    return execute_query(query, (IDEMPOTENCY_WINDOW,))
@@ -0,0 +1,199 @@
+"""
+In-process cache of finished images for get_image.
+
+Clients fetch the same freshly finished images over and over (retries, grid
+re-renders, full-screen views). Final images never change, so they are kept
+in an LRU bounded by IMAGE_CACHE_MAX_BYTES of image data. Entries also expire
+after IMAGE_CACHE_TTL seconds, so results purged by the retention job in
+another process stop being served. Previews are not cached because their
+full-resolution pass will replace them.
+
+Concurrent misses for the same image share one database read (single-flight).
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from db import execute_query, use_primary, DB_REPLICA_HOSTS
+import job_states
+
+logger = logging.getLogger(__name__)
+
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+# Larger images are served but not cached, so one can't flush the whole cache.
+IMAGE_CACHE_MAX_ITEM_BYTES = int(os.getenv('IMAGE_CACHE_MAX_ITEM_BYTES', str(8 * 1024 * 1024)))
+IMAGE_CACHE_TTL = float(os.getenv('IMAGE_CACHE_TTL', '600'))
+
+# Statuses after which a result's image never changes.
+FINAL_STATUSES = (job_states.READY,)
+
+CachedImage = namedtuple('CachedImage', ['user_id', 'status', 'tier', 'data', 'mime_type'])
+ImageLookup = namedtuple('ImageLookup', ['status', 'stored_tier', 'image'])
+
+
+class ImageCache:
+    """
+    Thread-safe LRU of CachedImage entries with a byte budget.
+
+    Args:
+        max_bytes: Total image bytes kept; 0 disables the cache
+        max_item_bytes: Images larger than this are never cached
+        ttl: Seconds an entry is served before it is read again
+    """
+
+    def __init__(self, max_bytes=IMAGE_CACHE_MAX_BYTES, max_item_bytes=IMAGE_CACHE_MAX_ITEM_BYTES,
+                 ttl=IMAGE_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = min(max_item_bytes, max_bytes)
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Get a cached image and mark it recently used, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                image, expires = entry
+                if time.monotonic() < expires:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return image
+                self._remove(key)
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, image):
+        """Cache an image, evicting the least recently used ones to stay in budget."""
+        size = len(image.data)
+        if size > self.max_item_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (image, time.monotonic() + self.ttl)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        image, _ = self._entries.pop(key)
+        self._bytes -= len(image.data)
+
+    def stats(self):
+        """Size, budget and hit/eviction counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class SingleFlight:
+    """Run one call per key at a time and hand its result to every concurrent caller."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """
+        Call fn(), or wait for the call already running for key.
+
+        Returns:
+            The result of fn; exceptions raised by fn are raised in every caller
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call['done'].wait()
+        else:
+            try:
+                call['result'] = fn()
+            except Exception as e:
+                call['error'] = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call['done'].set()
+
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
+
+
+_cache = ImageCache()
+_flight = SingleFlight()
+
+
+def _load(result_image_id, user_id):
+    # Status and blob in one round trip; the blob is only read once something is stored
+    query = """
+        SELECT ir.status, ir.stored_tier, i.data, i.mime_type
+        FROM image_requests ir
+        LEFT JOIN images i ON i.id = ir.result_image_id
+            AND (ir.status = %s OR ir.stored_tier IS NOT NULL)
+        WHERE ir.result_image_id = %s AND ir.user_id = %s
+    """
+    result = execute_query(query, (job_states.READY, result_image_id, user_id))
+    if not result and DB_REPLICA_HOSTS:
+        # A result created moments ago may not have reached the replica yet
+        with use_primary():
+            result = execute_query(query, (job_states.READY, result_image_id, user_id))
+    if not result:
+        return ImageLookup(None, None, None)
+    status, stored_tier, data, mime_type = result[0]
+    if data is None:
+        return ImageLookup(status, stored_tier, None)
+    image = CachedImage(user_id, status, stored_tier, bytes(data), mime_type)
+    if status in FINAL_STATUSES and _cache.max_bytes > 0:
+        _cache.put(result_image_id, image)
+    return ImageLookup(status, stored_tier, image)
+
+
+def lookup(result_image_id, user_id):
+    """
+    Get the status of a result and its stored image, from the cache if possible.
+
+    Args:
+        result_image_id: The result to look up
+        user_id: The user asking; other users' results are reported as not found
+
+    Returns:
+        ImageLookup: status is None if the result doesn't exist for the user,
+        image is None if no version of it is stored
+    """
+    image = _cache.get(result_image_id) if _cache.max_bytes > 0 else None
+    if image is not None and image.user_id == user_id:
+        return ImageLookup(image.status, image.tier, image)
+    return _flight.do((result_image_id, user_id), lambda: _load(result_image_id, user_id))
+
+
+def stats():
+    """Cache stats plus the number of reads saved by coalescing."""
+    return dict(_cache.stats(), coalesced=_flight.coalesced)
@@ -0,0 +1,195 @@
+"""
+Perceptual hashing of uploads and an in-memory near-duplicate index.
+
+A re-cropped or re-compressed selfie has different bytes but almost the same
+dHash, so /api/create can spot it and let the workers reuse the vision
+description (and optionally the finished results) of the earlier upload.
+
+Hashes are 64-bit dHashes stored in images.metadata as 16 hex digits under
+'phash'. The index is per process, warmed from the most recent uploads on
+first use, and groups entries by user_description so a lookup only compares
+against uploads that would have produced the same prompt.
+
+numpy and Pillow are imported on first use, so web processes don't pay for
+them at startup.
+"""
+
+import logging
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from io import BytesIO
+
+from db import execute_query
+
+logger = logging.getLogger(__name__)
+
+PHASH_MAX_DISTANCE = int(os.getenv('PHASH_MAX_DISTANCE', '6'))
+PHASH_INDEX_MAX_ENTRIES = int(os.getenv('PHASH_INDEX_MAX_ENTRIES', '50000'))
+PHASH_INDEX_WARM_ENTRIES = int(os.getenv('PHASH_INDEX_WARM_ENTRIES', '5000'))
+PHASH_REUSE_RESULTS = os.getenv('PHASH_REUSE_RESULTS', '').lower() in ('1', 'true', 'yes')
+
+HASH_SIZE = 8
+
+Match = namedtuple('Match', ['image_id', 'user_id', 'distance'])
+
+
+def dhash(img, hash_size=HASH_SIZE):
+    """
+    Difference hash of a Pillow image.
+
+    The image is shrunk to (hash_size + 1) x hash_size grayscale pixels and
+    each bit records whether a pixel is brighter than its right neighbour.
+
+    Returns:
+        int: hash_size * hash_size bit hash
+    """
+    import numpy as np
+    from PIL import Image
+
+    small = img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def dhash_bytes(image_data):
+    """
+    dHash of an encoded image.
+
+    JPEGs are decoded at reduced scale via draft mode, since the hash only
+    needs a 9x8 thumbnail.
+    """
+    from PIL import Image
+
+    img = Image.open(BytesIO(image_data))
+    img.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+    return dhash(img)
+
+
+def hamming_distances(hashes, value):
+    """Bit distance between every hash in a uint64 array and value."""
+    import numpy as np
+
+    xor = np.bitwise_xor(hashes, np.uint64(value))
+    return np.unpackbits(xor.view(np.uint8)).reshape(len(hashes), 64).sum(axis=1)
+
+
+class _Bucket:
+    """Entries sharing one user_description, with a lazily rebuilt hash array."""
+
+    __slots__ = ('hashes', 'image_ids', 'user_ids', '_array')
+
+    def __init__(self):
+        self.hashes = []
+        self.image_ids = []
+        self.user_ids = []
+        self._array = None
+
+    def add(self, value, image_id, user_id):
+        self.hashes.append(value)
+        self.image_ids.append(image_id)
+        self.user_ids.append(user_id)
+        self._array = None
+
+    def pop_oldest(self):
+        self.hashes.pop(0)
+        self.image_ids.pop(0)
+        self.user_ids.pop(0)
+        self._array = None
+
+    def array(self):
+        if self._array is None:
+            import numpy as np
+            self._array = np.fromiter(self.hashes, dtype=np.uint64, count=len(self.hashes))
+        return self._array
+
+
+class PerceptualHashIndex:
+    """
+    Thread-safe index of upload hashes supporting Hamming-distance lookup.
+
+    Args:
+        max_distance: Largest bit distance still considered the same picture
+        max_entries: Oldest entries are evicted past this size
+    """
+
+    def __init__(self, max_distance=PHASH_MAX_DISTANCE, max_entries=PHASH_INDEX_MAX_ENTRIES):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def add(self, value, user_description, image_id, user_id=None):
+        """Record an upload's hash."""
+        key = user_description or ''
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = _Bucket()
+            bucket.add(value, str(image_id), str(user_id) if user_id else None)
+            self._buckets.move_to_end(key)
+            self._size += 1
+            while self._size > self.max_entries:
+                oldest_key, oldest = next(iter(self._buckets.items()))
+                oldest.pop_oldest()
+                self._size -= 1
+                if not oldest.hashes:
+                    del self._buckets[oldest_key]
+
+    def find(self, value, user_description):
+        """
+        Find the closest earlier upload with the same user_description.
+
+        Returns:
+            Match or None: The nearest entry within max_distance bits
+        """
+        with self._lock:
+            bucket = self._buckets.get(user_description or '')
+            if bucket is None:
+                return None
+            hashes = bucket.array()
+            image_ids = list(bucket.image_ids)
+            user_ids = list(bucket.user_ids)
+
+        distances = hamming_distances(hashes, value)
+        best = int(distances.argmin())
+        if distances[best] > self.max_distance:
+            return None
+        return Match(image_ids[best], user_ids[best], int(distances[best]))
+
+    def __len__(self):
+        return self._size
+
+
+def _warm(index):
+    rows = execute_query("""
+        SELECT id, user_id, metadata->>'phash', metadata->>'user_description'
+        FROM images
+        WHERE metadata ? 'phash'
+        ORDER BY created_at DESC
+        LIMIT %s
+    """, (PHASH_INDEX_WARM_ENTRIES,)) or []
+    for image_id, user_id, phash, user_description in reversed(rows):
+        index.add(int(phash, 16), user_description, image_id, user_id)
+    logger.info(f"Warmed perceptual hash index with {len(rows)} uploads")
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Get the process-wide PerceptualHashIndex, warming it on first use."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index = PerceptualHashIndex()
+                try:
+                    _warm(index)
+                except Exception as e:
+                    logger.error(f"Error warming perceptual hash index: {str(e)}")
+                _index = index
+    return _index
@@ -0,0 +1,184 @@
+"""
+Lifecycle of an image_requests row (one generated result).
+
+    new ───┐
+           ├─ claim ──> processing ── finish ──> ready ── expire ──> expired
+    retry ─┘                │  └── store_preview ──> new (preview stored, full pass queued)
+                            └── fail ──> retry, or failed after JOB_MAX_ATTEMPTS claims
+    new / retry / processing ── cancel ──> cancelled
+
+The retention job moves any result whose image it purges to expired.
+
+Each result sits on one queue: GENERATE jobs are taken by process_images.py,
+TEST jobs by the test processor background.py, which copies an existing
+image instead of calling OpenAI. /api/create queues on JOB_QUEUE.
+
+Every transition is one conditional UPDATE that only matches rows still in
+the expected source state (compare-and-set). A caller whose update matched
+nothing lost a race, e.g. the result was cancelled or another worker claimed
+it, and must drop the job. finish() and store_preview() write the image in
+the same statement as the status change, so a result is never ready without
+its image and a cancelled job never stores one.
+
+A trigger on image_requests records each insert, status or priority change
+and delete as +1/-1 rows in job_state_deltas (see postgres/init.sql).
+Appending takes no row locks, so concurrent transitions never wait on or
+deadlock over counters. counts() first folds the deltas into
+job_state_counts, then sums both, which costs the same however large
+image_requests grows. reconcile_counts() rebuilds the counters after changes
+that skip row triggers, such as dropping partitions.
+"""
+
+import logging
+import os
+
+from db import execute_query, maintenance_connection
+
+logger = logging.getLogger(__name__)
+
+NEW = 'new'
+RETRY = 'retry'
+PROCESSING = 'processing'
+READY = 'ready'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+EXPIRED = 'expired'
+
+QUEUED = (NEW, RETRY)
+UNFINISHED = QUEUED + (PROCESSING,)
+
+STATES = (NEW, RETRY, PROCESSING, READY, FAILED, CANCELLED, EXPIRED)
+
+GENERATE = 'generate'
+TEST = 'test'
+
+# Queue new jobs from /api/create go to; 'test' hands them to background.py.
+JOB_QUEUE = os.getenv('JOB_QUEUE', GENERATE)
+
+# Claims a result gets before a failure is final.
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+
+
+def claim(result_image_id):
+    """
+    Move a queued result to processing.
+
+    Returns:
+        bool: False if the result is no longer queued (cancelled, or claimed elsewhere)
+    """
+    query = """
+        UPDATE image_requests SET status = %s, attempts = attempts + 1
+        WHERE result_image_id = %s AND status = ANY(%s)
+    """
+    return execute_query(query, (PROCESSING, result_image_id, list(QUEUED))) > 0
+
+
+def _store(result_image_id, data, mime_type, metadata, assignments, params):
+    query = f"""
+        WITH moved AS (
+            UPDATE image_requests SET {assignments}
+            WHERE result_image_id = %s AND status = %s
+            RETURNING result_image_id, user_id
+        )
+        INSERT INTO images (id, user_id, data, mime_type, metadata)
+        SELECT result_image_id, user_id, %s, %s, %s FROM moved
+        ON CONFLICT (id) DO UPDATE
+        SET data = EXCLUDED.data,
+            mime_type = EXCLUDED.mime_type,
+            metadata = COALESCE(EXCLUDED.metadata, images.metadata)
+        RETURNING id
+    """
+    rows = execute_query(
+        query,
+        params + (result_image_id, PROCESSING, data, mime_type, metadata),
+        fetch=True
+    )
+    return bool(rows)
+
+
+def finish(result_image_id, data, mime_type, tier, metadata=None):
+    """
+    Store a result's image and move it from processing to ready, in one statement.
+
+    Args:
+        result_image_id: The result being processed
+        data: Image bytes
+        mime_type: MIME type of data
+        tier: Quality tier of the image (see quality.py)
+        metadata: JSON string for images.metadata, or None to keep what is there
+
+    Returns:
+        bool: False if the result left processing meanwhile; nothing was written
+    """
+    return _store(result_image_id, data, mime_type, metadata,
+                  "status = %s, stored_tier = %s, completed_at = NOW()", (READY, tier))
+
+
+def store_preview(result_image_id, data, mime_type, tier, next_tier, priority, metadata=None):
+    """
+    Store a preview and queue the result again for its next_tier pass at priority.
+
+    completed_at is left unset: admission counts it as a completed job, and
+    the job only completes with its final pass.
+
+    Returns:
+        bool: False if the result left processing meanwhile; nothing was written
+    """
+    return _store(result_image_id, data, mime_type, metadata,
+                  "status = %s, stored_tier = %s, quality_tier = %s, priority = %s, attempts = 0",
+                  (NEW, tier, next_tier, priority))
+
+
+def fail(result_image_id, max_attempts=JOB_MAX_ATTEMPTS):
+    """
+    Move a processing result to retry, or to failed once it used max_attempts claims.
+
+    Returns:
+        str or None: The new status, None if the result left processing meanwhile
+    """
+    query = """
+        UPDATE image_requests
+        SET status = CASE WHEN attempts < %s THEN %s ELSE %s END
+        WHERE result_image_id = %s AND status = %s
+        RETURNING status
+    """
+    rows = execute_query(query, (max_attempts, RETRY, FAILED, result_image_id, PROCESSING), fetch=True)
+    return rows[0][0] if rows else None
+
+
+def counts():
+    """
+    Current number of results per state and priority, from the counter table.
+
+    Returns:
+        dict: {(status, priority): count} for every non-empty combination
+    """
+    # Skipped in the database while another process is folding
+    execute_query("CALL fold_job_state_deltas()")
+    query = """
+        SELECT status, priority, SUM(count) FROM (
+            SELECT status, priority, count FROM job_state_counts
+            UNION ALL
+            SELECT status, priority, delta FROM job_state_deltas
+        ) counters
+        GROUP BY status, priority
+    """
+    rows = execute_query(query)
+    return {(status, priority): int(count) for status, priority, count in rows or [] if count}
+
+
+def totals(state_counts):
+    """Collapse counts() to {status: count}."""
+    result = {}
+    for (status, _), count in state_counts.items():
+        result[status] = result.get(status, 0) + count
+    return result
+
+
+def reconcile_counts():
+    """Rebuild job_state_counts from image_requests with one full count."""
+    with maintenance_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("CALL reconcile_job_state_counts()")
+        conn.commit()
+    logger.info("Rebuilt job state counters")
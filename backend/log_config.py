@@ -0,0 +1,222 @@
+"""
+Logging setup shared by the web app and the background workers.
+
+Records are handed to a bounded in-memory queue and written to stderr by a
+single listener thread, so request handlers never block on I/O. Output is
+one JSON object per line and carries the current request id. Chatty loggers
+can be sampled per logger name; warnings and errors are never sampled.
+
+Environment variables:
+    LOG_LEVEL:        root level (default INFO)
+    LOG_FORMAT:       'json' (default) or 'text'
+    LOG_QUEUE_SIZE:   max records buffered before new ones are dropped (default 10000)
+    LOG_SAMPLE_RATES: comma separated 'logger=rate' pairs, e.g. 'helper=0.1,background=0.25'.
+                      Loggers are named after their module; the workers log as
+                      'background' and 'process_images' even when run as scripts.
+    DEBUG_PAYLOADS:   set to 1/true to log request headers, forms and raw DB results
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+# Checked at the call site (``if DEBUG_PAYLOADS: logger.debug(...)``) so the
+# payload is never even formatted when the flag is off.
+DEBUG_PAYLOADS = os.getenv('DEBUG_PAYLOADS', '').lower() in ('1', 'true', 'yes')
+
+_request_id = contextvars.ContextVar('request_id', default=None)
+
+_configure_lock = threading.Lock()
+_listener = None
+_queue_handler = None
+
+
+def get_request_id():
+    """Return the request id bound to the current context, if any."""
+    return _request_id.get()
+
+
+def set_request_id(request_id):
+    """
+    Bind a request id to the current context.
+
+    Args:
+        request_id: The id to attach to every record logged from this context
+
+    Returns:
+        contextvars.Token: Token that can be passed to reset_request_id
+    """
+    return _request_id.set(str(request_id) if request_id is not None else None)
+
+
+def reset_request_id(token):
+    """Restore the request id that was bound before set_request_id."""
+    _request_id.reset(token)
+
+
+def parse_sample_rates(spec):
+    """
+    Parse a 'logger=rate,logger=rate' string into a dict.
+
+    Invalid entries are ignored and rates are clamped to [0, 1].
+    """
+    rates = {}
+    for item in (spec or '').split(','):
+        name, sep, value = item.partition('=')
+        if not sep:
+            continue
+        try:
+            rates[name.strip()] = min(1.0, max(0.0, float(value)))
+        except ValueError:
+            continue
+    return rates
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamp each record with the request id of the context that logged it."""
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Drop a fraction of INFO/DEBUG records per logger.
+
+    The rate for a record is taken from the longest configured logger name
+    that prefixes the record's logger name, so 'helper' also covers 'helper.x'.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self._cache = {}
+
+    def _rate_for(self, name):
+        rate = self._cache.get(name)
+        if rate is None:
+            rate = 1.0
+            best = -1
+            for prefix, value in self.rates.items():
+                if (name == prefix or name.startswith(prefix + '.')) and len(prefix) > best:
+                    rate, best = value, len(prefix)
+            self._cache[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self._rate_for(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as single-line JSON objects."""
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))
+                  + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'thread': record.threadName,
+        }
+        request_id = getattr(record, 'request_id', None)
+        if request_id:
+            entry['request_id'] = request_id
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Render the traceback here: exc_info cannot be carried across the
+        # queue, and the listener has no access to the original frame.
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _build_formatter():
+    if LOG_FORMAT == 'text':
+        return logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'
+        )
+    return JsonFormatter()
+
+
+def configure_logging():
+    """
+    Install the queue-based handler on the root logger.
+
+    Safe to call from every module; only the first call has an effect.
+    """
+    global _listener, _queue_handler
+    with _configure_lock:
+        if _listener is not None:
+            return
+
+        stream_handler = logging.StreamHandler(sys.stderr)
+        stream_handler.setFormatter(_build_formatter())
+
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        _queue_handler = NonBlockingQueueHandler(log_queue)
+        _queue_handler.addFilter(SamplingFilter(parse_sample_rates(os.getenv('LOG_SAMPLE_RATES'))))
+        _queue_handler.addFilter(RequestIdFilter())
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(_queue_handler)
+        root.setLevel(LOG_LEVEL)
+
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def dropped_records():
+    """Number of records dropped because the log queue was full."""
+    return _queue_handler.dropped if _queue_handler is not None else 0
@@ -1,8 +1,10 @@
 from flask import Flask
-from flask import request, send_file, jsonify    
+from flask import request, send_file, jsonify, g, Response
 import io
 import logging
+import math
 import os
+import time
 from dotenv import load_dotenv
 from helper import process_image_with_theme
 from helper import theme_descriptions
@@ -11,13 +13,34 @@ from helper import init_user
 import random
 from io import BytesIO  
 import uuid
-from db import execute_query
+from db import execute_query, reset_primary_pin, open_connection_scope, close_connection_scope
+from db import pool_stats, replica_status, primary_pinned_until, DB_REPLICA_HOSTS, DB_STICKY_PRIMARY_SECONDS
+from functools import wraps
 import json
 from helper import get_themes
+from theme_ranking import get_ranker
+import admission
+import quality
+import job_states
+import image_cache
+import warmup
+import idempotency
+from action_log import log_action
+import profiling
+from cancellation import cancel_request, cancel_previous_requests, AUTO_CANCEL_PREVIOUS
+from bundle import iter_ready_results, stream_multipart, stream_zip
+from image_hash import dhash_bytes, get_index as get_phash_index, PHASH_REUSE_RESULTS
+from log_config import configure_logging, set_request_id, DEBUG_PAYLOADS
 # Load environment variables from .env file if present
 load_dotenv()
 FLASK_PORT = os.getenv('FLASK_PORT')
 print(f"FLASK_PORT: {FLASK_PORT}")
+# Number of themed images generated for each upload
+THEMES_PER_REQUEST = 12
+# Cookie carrying the time until which a client's reads go to the primary.
+PRIMARY_UNTIL_COOKIE = 'primary_until'
+# Admin endpoints are disabled unless a token is configured.
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
 
 # Enable CORS for all routes
 from flask_cors import CORS
@@ -25,16 +48,109 @@ from flask_cors import CORS
 app = Flask(__name__)
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Initialize CORS with default settings to allow all origins
 CORS(app)
 
+# Open database connections in the background; /api/ready reports when done
+warmup.start()
+
+@app.before_request
+def bind_request_id():
+    """
+    Tag every log record of this request with the client's X-Request-ID, or a fresh one,
+    and start the request with reads allowed on replicas.
+    """
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    set_request_id(g.request_id)
+    reset_primary_pin(read_primary_until())
+
+@app.after_request
+def echo_request_id(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+def read_primary_until():
+    """
+    Epoch seconds from the X-Primary-Until header or primary_until cookie, or None.
+
+    Both are client-controlled, so times further ahead than a write could have
+    set are ignored; otherwise a client could keep all its reads on the primary.
+    """
+    value = request.headers.get('X-Primary-Until') or request.cookies.get(PRIMARY_UNTIL_COOKIE)
+    try:
+        pinned_until = float(value) if value else None
+    except ValueError:
+        return None
+    if pinned_until is None or not pinned_until <= time.time() + DB_STICKY_PRIMARY_SECONDS:
+        return None
+    return pinned_until
+
+@app.after_request
+def pin_client_to_primary(response):
+    """
+    Keep a client that just wrote on the primary for its next requests, so the
+    status polls right after /api/create don't hit a replica that lags behind.
+    Browsers get a cookie; other clients can echo X-Primary-Until.
+    """
+    pinned_until = primary_pinned_until() if DB_REPLICA_HOSTS else None
+    if pinned_until is not None:
+        response.headers['X-Primary-Until'] = f"{pinned_until:.3f}"
+        response.set_cookie(PRIMARY_UNTIL_COOKIE, f"{pinned_until:.3f}",
+                            max_age=max(1, int(pinned_until - time.time()) + 1), httponly=True)
+    return response
+
+@app.before_request
+def bind_db_connection():
+    """Reuse one pooled connection for every query of this request."""
+    g.db_scope = open_connection_scope()
+
+@app.teardown_request
+def release_db_connection(exc):
+    if 'db_scope' in g:
+        close_connection_scope(g.pop('db_scope'))
+
+@app.before_request
+def start_request_profile():
+    """Profile requests sent with X-Profile: 1 (if enabled) or picked by PROFILE_SAMPLE_RATE."""
+    if profiling.should_profile_request(request.headers):
+        g.profile = profiling.start_profile(f"web-{request.endpoint}")
+
+@app.after_request
+def add_profile_header(response):
+    if 'profile' in g:
+        response.headers['X-Profile-Id'] = g.profile[0].id
+    return response
+
+@app.teardown_request
+def finish_request_profile(exc):
+    if 'profile' in g:
+        profiling.finish_profile(*g.pop('profile'))
+
+def admin_required(view):
+    """Only allow requests carrying the ADMIN_TOKEN in the X-Admin-Token header."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN or request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
+            return jsonify({'error': 'Not found'}), 404
+        return view(*args, **kwargs)
+    return wrapper
+
 @app.route('/')
 def hello_world():
     return 'Hello, World!'
 
+@app.route('/api/ready', methods=['GET'])
+def readiness():
+    """
+    Readiness probe: 503 until the connection pools and theme catalog are warm.
+    """
+    status = warmup.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
 @app.route('/api/test-db', methods=['GET'])
 def test_db_connection():
     try:
@@ -65,16 +181,18 @@ def test_db_connection():
 def generate_image():
     try:
         logger.info("Received request to /api/gen")
-        logger.info(f"Request headers: {dict(request.headers)}")
-        logger.info(f"Request form data: {request.form.to_dict()}")
-        logger.info(f"Request files: {request.files.to_dict()}")
+        if DEBUG_PAYLOADS:
+            logger.debug(f"Request headers: {dict(request.headers)}")
+            logger.debug(f"Request form data: {request.form.to_dict()}")
+            logger.debug(f"Request files: {request.files.to_dict()}")
         
         # Get the prompt (required)
         user_description = request.form.get('user_description')
         theme_description = request.form.get('theme_description')
             
-        logger.info(f"Received user description: {user_description}")
-        logger.info(f"Received theme description: {theme_description}")
+        if DEBUG_PAYLOADS:
+            logger.debug(f"Received user description: {user_description}")
+            logger.debug(f"Received theme description: {theme_description}")
         
         # Check if all required parameters are provided
         if not user_description:
@@ -170,7 +288,12 @@ def create_image_request():
     2. Check user credits
     3. Get 12 themes for user
     4. Return list of result_image_ids for async processing
+    
+    A client-supplied request_id is an idempotency key: repeating the call
+    returns the original response instead of creating the work again.
     """
+    # Set once this call owns the client's request_id, cleared when the response is stored
+    claimed_request_id = None
     try:
         logger.info("Received request to /api/create")
         
@@ -178,6 +301,10 @@ def create_image_request():
         user_id = request.form.get('user_id')
         user_description = request.form.get('user_description', '')
         request_id = request.form.get('request_id', str(uuid.uuid4()))
+        # Tag the rest of this request like the workers tag its jobs, so their logs join up
+        if request_id != g.get('request_id'):
+            logger.info(f"Handling create request {request_id}")
+            set_request_id(request_id)
         
         # Validate required parameters
         if not user_id:
@@ -188,6 +315,32 @@ def create_image_request():
         # Check if an image file was uploaded
         if 'image' not in request.files:
             return jsonify({'error': 'Missing image file'}), 400
+        
+        # Replay the stored response for a retried request_id
+        if 'request_id' in request.form:
+            existing = idempotency.claim(request_id, user_id)
+            if existing.claimed:
+                claimed_request_id = request_id
+            elif existing.user_id != user_id:
+                return jsonify({'error': 'request_id already used'}), 409
+            elif existing.response is None:
+                response = jsonify({'error': 'Request is still being created, retry shortly'})
+                response.headers['Retry-After'] = '1'
+                return response, 409
+            else:
+                logger.info(f"Returning stored response for repeated request {request_id}")
+                return jsonify(existing.response)
+        
+        # Turn work away while the backlog is too deep for the workers to reach it in time
+        decision = admission.check(THEMES_PER_REQUEST)
+        if not decision.admitted:
+            response = jsonify({
+                'error': 'Too many pending requests, retry later',
+                'retry_after': decision.retry_after,
+                'estimated_wait_seconds': round(decision.estimated_wait, 1)
+            })
+            response.headers['Retry-After'] = str(decision.retry_after)
+            return response, 429
             
         image_file = request.files['image']
         logger.info(f"Received image file: {image_file.filename}")
@@ -196,6 +349,16 @@ def create_image_request():
         image_data = image_file.read()
         image_file.seek(0)  # Reset file pointer for any future use
         
+        # Fingerprint the upload so near-duplicates can reuse earlier work
+        phash = None
+        duplicate = None
+        try:
+            with profiling.stage('hash_upload'):
+                phash = dhash_bytes(image_data)
+                duplicate = get_phash_index().find(phash, user_description)
+        except Exception as e:
+            logger.warning(f"Could not hash uploaded image: {str(e)}")
+        
         # Step 1: Save image to database
         source_image_id = str(uuid.uuid4())
         query = """
@@ -203,29 +366,75 @@ def create_image_request():
             VALUES (%s, %s, %s, %s, %s)
             RETURNING id
         """
-        metadata = json.dumps({"user_description": user_description})
-        execute_query(query, (source_image_id, user_id, image_data, image_file.content_type, metadata))
+        metadata = {"user_description": user_description}
+        if phash is not None:
+            metadata['phash'] = f"{phash:016x}"
+        if duplicate:
+            logger.info(f"Upload is a near-duplicate of {duplicate.image_id} (distance {duplicate.distance})")
+            metadata['duplicate_of'] = duplicate.image_id
+        execute_query(query, (source_image_id, user_id, image_data, image_file.content_type, json.dumps(metadata)))
         logger.info(f"Saved source image with ID: {source_image_id}")
+        if phash is not None:
+            get_phash_index().add(phash, user_description, source_image_id, user_id)
         
         # Step 2: Check user credits - we don't actually deduct credits at this stage,
         # but we need to verify they have at least 1 credit
         if not use_credits(user_id, 0):
             return jsonify({'error': 'User not found or invalid account'}), 404
             
-        # todo: get it from db
-        selected_themes = get_themes(user_id, 12)
-        
-        # Step 4: Create result_image_ids for async processing
+        # Step 3: Serve themes the user already got for a near-identical upload
         result_image_ids = []
+        reused = []
+        reused_themes = set()
+        if duplicate and PHASH_REUSE_RESULTS and duplicate.user_id == user_id:
+            query = """
+                SELECT theme_id, result_image_id, status, stored_tier FROM image_requests
+                WHERE source_image_id = %s AND status = %s
+                LIMIT %s
+            """
+            reused = execute_query(query, (duplicate.image_id, job_states.READY, THEMES_PER_REQUEST)) or []
+        
+        for theme_id, earlier_result_image_id, status, stored_tier in reused:
+            result_image_id = str(uuid.uuid4())
+            # Copy the finished image inside the database, no round trip through Python
+            query = """
+                INSERT INTO images (id, user_id, data, mime_type, metadata)
+                SELECT %s, %s, data, mime_type, metadata FROM images WHERE id = %s
+            """
+            if not execute_query(query, (result_image_id, user_id, earlier_result_image_id)):
+                continue
+            query = """
+                INSERT INTO image_requests 
+                (request_id, source_image_id, theme_id, result_image_id, user_id, user_description, status,
+                 stored_tier, created_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())
+            """
+            execute_query(query, (request_id, source_image_id, theme_id, result_image_id, user_id, user_description, status,
+                                  stored_tier))
+            result_image_ids.append(result_image_id)
+            reused_themes.add(theme_id)
+        if result_image_ids:
+            logger.info(f"Reused {len(result_image_ids)} finished themes from {duplicate.image_id}")
         
+        selected_themes = [
+            theme_id for theme_id in get_themes(user_id, THEMES_PER_REQUEST + len(reused_themes))
+            if theme_id not in reused_themes
+        ][:THEMES_PER_REQUEST - len(result_image_ids)]
+        
+        # Step 4: Create result_image_ids for async processing, as quick previews
+        # while the backlog is deep
+        tier = quality.choose_tier(decision.estimated_wait)
+        if tier != quality.FULL:
+            logger.info(f"Queueing {tier} jobs, estimated wait {decision.estimated_wait:.0f}s")
         for i, theme_id in enumerate(selected_themes):
             result_image_id = str(uuid.uuid4())
             
             # Record the processing request in the database
             query = """
                 INSERT INTO image_requests 
-                (request_id, source_image_id, theme_id, result_image_id, user_id, user_description, status, created_at) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
+                (request_id, source_image_id, theme_id, result_image_id, user_id, user_description, status,
+                 quality_tier, queue, created_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())
             """
             execute_query(query, (
                 request_id, 
@@ -234,7 +443,9 @@ def create_image_request():
                 result_image_id, 
                 user_id,
                 user_description,
-                'new'
+                job_states.NEW,
+                tier,
+                job_states.JOB_QUEUE
             ))
             
             result_image_ids.append(result_image_id)
@@ -244,22 +455,45 @@ def create_image_request():
         # For now, just log that this would happen
         logger.info(f"Would trigger async processing for {len(result_image_ids)} themes")
         
+        admission.record_admitted(len(selected_themes))
+        get_ranker().record_seen(user_id, selected_themes)
+        
+        # The user moved on, stop generating their earlier requests. Only now
+        # that this one is queued, so a rejected or failed create loses nothing.
+        if AUTO_CANCEL_PREVIOUS:
+            admission.record_cancelled(cancel_previous_requests(user_id, request_id))
+        
         # Return the list of result_image_ids
-        return jsonify({
+        response = {
             'request_id': request_id,
             'source_image_id': source_image_id,
-            'result_image_ids': result_image_ids
-        })
+            'result_image_ids': result_image_ids,
+            'estimated_wait_seconds': round(decision.estimated_wait, 1),
+            'quality_tier': tier
+        }
+        if claimed_request_id:
+            idempotency.save_response(claimed_request_id, response)
+            claimed_request_id = None
+        return jsonify(response)
             
     except Exception as e:
         logger.error(f"Error creating image request: {str(e)}")
         return jsonify({'error': f'Error creating image request: {str(e)}'}), 500
+    finally:
+        # Let the client retry a create that did not finish
+        if claimed_request_id:
+            try:
+                idempotency.release(claimed_request_id)
+            except Exception as e:
+                logger.error(f"Error releasing request_id {claimed_request_id}: {str(e)}")
 
 @app.route('/api/image/<result_image_id>', methods=['GET'])
 def get_image(result_image_id):
     """
     Get a generated image by its result_image_id.
-    If the image is not ready, returns status information.
+    Serves the best version stored so far; the X-Quality-Tier header says
+    which, and X-Upgrade-Pending is set while a full-resolution pass is queued.
+    If no version is stored yet, returns status information.
     """
     try:
         logger.info(f"Received request for image with ID: {result_image_id}")
@@ -269,54 +503,122 @@ def get_image(result_image_id):
         if not user_id:
             return jsonify({'error': 'Missing user_id parameter'}), 400
             
-        # Look up the image request status
-        query = """
-            SELECT status, result_image_id FROM image_requests 
-            WHERE result_image_id = %s AND user_id = %s
-        """
-        result = execute_query(query, (result_image_id, user_id))
+        # Look up the image request status, and the image once one is stored
+        status, stored_tier, image = image_cache.lookup(result_image_id, user_id)
         
-        if not result:
+        if status is None:
             return jsonify({
                 'ready': False,
                 'status': 'not_found',
                 'result_image_id': result_image_id
             })
             
-        status, result_image_id = result[0]
-        
-        # If the image is still processing, return the status
-        if status != 'ready':
+        # If nothing has been stored yet, return the status
+        if status != job_states.READY and stored_tier is None:
             return jsonify({
                 'ready': False,
                 'status': status,
                 'result_image_id': result_image_id
             })
             
-        # Get the image data from the database
-        query = "SELECT data, mime_type FROM images WHERE id = %s"
-        image_result = execute_query(query, (result_image_id,))
-        
-        if not image_result:
+        if image is None:
             return jsonify({'error': 'Image data not found'}), 404
             
-        image_data, mime_type = image_result[0]
-        
         # Create a BytesIO object from the image data
-        image_io = BytesIO(image_data)
+        image_io = BytesIO(image.data)
         
         # Return the image
-        return send_file(
+        response = send_file(
             image_io,
-            mimetype=mime_type,
+            mimetype=image.mime_type,
             as_attachment=False
         )
+        response.headers['X-Quality-Tier'] = stored_tier or quality.FULL
+        if status in job_states.UNFINISHED:
+            response.headers['X-Upgrade-Pending'] = '1'
+        return response
             
     except Exception as e:
         logger.error(f"Error retrieving image: {str(e)}")
         return jsonify({'error': f'Error retrieving image: {str(e)}'}), 500
 
 
+@app.route('/api/request/<request_id>/images', methods=['GET'])
+def get_request_images(request_id):
+    """
+    Stream every finished image of a request in one response.
+    
+    Query parameters:
+        user_id: Owner of the request (required)
+        format: 'multipart' (default, multipart/mixed) or 'zip'
+    """
+    try:
+        logger.info(f"Received bundle request for request ID: {request_id}")
+        
+        user_id = request.args.get('user_id')
+        if not user_id:
+            return jsonify({'error': 'Missing user_id parameter'}), 400
+        
+        bundle_format = request.args.get('format', 'multipart')
+        if bundle_format not in ('multipart', 'zip'):
+            return jsonify({'error': 'format must be multipart or zip'}), 400
+        
+        results = iter_ready_results(request_id, user_id)
+        # Pull the first row now so errors and empty requests get a normal JSON reply
+        first = next(results, None)
+        if first is None:
+            return jsonify({
+                'ready': False,
+                'status': 'not_found',
+                'request_id': request_id
+            })
+        
+        def all_results():
+            yield first
+            yield from results
+        
+        if bundle_format == 'zip':
+            response = Response(stream_zip(all_results()), mimetype='application/zip')
+            response.headers['Content-Disposition'] = f'attachment; filename="{request_id}.zip"'
+        else:
+            boundary = uuid.uuid4().hex
+            response = Response(stream_multipart(all_results(), boundary), mimetype=f'multipart/mixed; boundary={boundary}')
+        # Closing the response closes the generator, which releases its DB connection
+        response.call_on_close(results.close)
+        return response
+            
+    except Exception as e:
+        logger.error(f"Error streaming request images: {str(e)}")
+        return jsonify({'error': f'Error streaming request images: {str(e)}'}), 500
+
+
+@app.route('/api/request/<request_id>/cancel', methods=['POST'])
+def cancel_image_request(request_id):
+    """
+    Cancel the results of a request that are not generated yet.
+    Queued results are never picked up; results being generated are dropped
+    at the worker's next stage boundary.
+    """
+    try:
+        logger.info(f"Received cancel request for request ID: {request_id}")
+        
+        user_id = request.form.get('user_id')
+        if not user_id:
+            return jsonify({'error': 'Missing user_id parameter'}), 400
+        
+        cancelled = cancel_request(request_id, user_id)
+        admission.record_cancelled(cancelled)
+        
+        return jsonify({
+            'request_id': request_id,
+            'cancelled': cancelled
+        })
+            
+    except Exception as e:
+        logger.error(f"Error cancelling request: {str(e)}")
+        return jsonify({'error': f'Error cancelling request: {str(e)}'}), 500
+
+
 @app.route('/api/image/test/<result_image_id>', methods=['GET'])
 def get_image_test(result_image_id):
     """
@@ -369,7 +671,7 @@ def download_image(result_image_id):
             
         # Verify the image exists and belongs to the user
         query = """
-            SELECT ir.status FROM image_requests ir
+            SELECT ir.status, ir.stored_tier FROM image_requests ir
             WHERE ir.result_image_id = %s AND ir.user_id = %s
         """
         result = execute_query(query, (result_image_id, user_id))
@@ -377,9 +679,10 @@ def download_image(result_image_id):
         if not result:
             return jsonify({'error': 'Image not found or unauthorized'}), 404
             
-        status = result[0][0]
+        status, stored_tier = result[0]
         
-        if status != 'completed':
+        # A stored preview can be downloaded while its full-resolution pass is pending
+        if status != job_states.READY and stored_tier is None:
             return jsonify({'error': 'Image is not ready for download'}), 400
             
         # Use helper function to deduct credits
@@ -391,16 +694,8 @@ def download_image(result_image_id):
         result = execute_query(query, (user_id,))
         remaining_credits = result[0][0]
         
-        # Log the download action
-        query = """
-            INSERT INTO actions (user_id, action, metadata, created_at)
-            VALUES (%s, %s, %s, NOW())
-        """
-        execute_query(query, (
-            user_id, 
-            'download_image', 
-            {'result_image_id': result_image_id}
-        ))
+        # Log the download action, written in the background
+        log_action(user_id, 'download_image', {'result_image_id': result_image_id})
         
         return jsonify({
             'success': True,
@@ -411,5 +706,57 @@ def download_image(result_image_id):
         logger.error(f"Error downloading image: {str(e)}")
         return jsonify({'error': f'Error downloading image: {str(e)}'}), 500
 
+@app.route('/api/queue', methods=['GET'])
+def get_queue_status():
+    """
+    Current backlog, worker throughput and how many more jobs would be admitted.
+    """
+    try:
+        return jsonify(admission.status())
+    except Exception as e:
+        logger.error(f"Error reading queue status: {str(e)}")
+        return jsonify({'error': f'Error reading queue status: {str(e)}'}), 500
+
+@app.route('/api/admin/pool', methods=['GET'])
+@admin_required
+def get_pool_stats():
+    """
+    Connection pool wait times and saturation, plus replica lag.
+    """
+    return jsonify({
+        'pools': pool_stats(),
+        'replicas': replica_status()
+    })
+
+@app.route('/api/admin/cache', methods=['GET'])
+@admin_required
+def get_cache_stats():
+    """
+    Size, hit rate and evictions of the in-process image cache.
+    """
+    return jsonify(image_cache.stats())
+
+@app.route('/api/admin/profile/stacks', methods=['GET'])
+@admin_required
+def get_stack_samples():
+    """
+    Sample every thread's stack of this process for `seconds` (default 10,
+    at most profiling.MAX_SAMPLE_SECONDS) every `interval` seconds (default
+    0.01, at most profiling.MAX_SAMPLE_INTERVAL) and return collapsed stacks,
+    ready for flamegraph.pl or speedscope.
+    """
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval = float(request.args.get('interval', 0.01))
+    except ValueError:
+        return jsonify({'error': 'seconds and interval must be numbers'}), 400
+    if not (math.isfinite(seconds) and math.isfinite(interval) and seconds > 0 and interval > 0):
+        return jsonify({'error': 'seconds and interval must be positive finite numbers'}), 400
+    return Response(profiling.sample_stacks(seconds, interval), mimetype='text/plain')
+
 if __name__ == '__main__':
+    # Exit normally on SIGTERM (docker stop) so atexit handlers drain queued action events
+    import signal
+    import sys
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(host='0.0.0.0', port=FLASK_PORT)
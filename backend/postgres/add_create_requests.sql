@@ -0,0 +1,13 @@
+-- Migration for databases created before idempotent /api/create.
+-- Without this table every /api/create with a request_id fails.
+BEGIN;
+
+-- Idempotency keys for /api/create: a retried request_id gets the stored response.
+CREATE TABLE IF NOT EXISTS create_requests (
+    request_id UUID PRIMARY KEY,
+    user_id UUID NOT NULL,
+    response JSONB,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMIT;
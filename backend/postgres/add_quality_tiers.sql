@@ -0,0 +1,15 @@
+-- Migration for databases created before generation quality tiers.
+BEGIN;
+
+ALTER TABLE image_requests
+    ADD COLUMN quality_tier TEXT NOT NULL DEFAULT 'full',
+    ADD COLUMN stored_tier TEXT,
+    ADD COLUMN priority SMALLINT NOT NULL DEFAULT 0;
+
+-- Everything generated so far was full resolution
+UPDATE image_requests SET stored_tier = 'full' WHERE status IN ('ready', 'completed');
+
+DROP INDEX IF EXISTS image_requests_status_created_at_idx;
+CREATE INDEX image_requests_status_priority_idx ON image_requests (status, priority, created_at);
+
+COMMIT;
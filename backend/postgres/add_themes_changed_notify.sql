@@ -0,0 +1,18 @@
+-- Migration for databases created before the in-memory theme catalog.
+-- Without this trigger, running processes never reload their catalog.
+BEGIN;
+
+-- Tell running processes to reload their in-memory theme catalog.
+CREATE OR REPLACE FUNCTION notify_themes_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('themes_changed', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS themes_changed ON themes;
+CREATE TRIGGER themes_changed
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON themes
+FOR EACH STATEMENT EXECUTE FUNCTION notify_themes_changed();
+
+COMMIT;
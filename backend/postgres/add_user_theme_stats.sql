@@ -0,0 +1,58 @@
+-- Migration for databases created before per-user theme ranking.
+-- Backfills user_theme_stats from existing requests and downloads.
+BEGIN;
+
+-- Per-user theme counts for theme_ranking.py, kept current by the triggers below.
+CREATE TABLE user_theme_stats (
+    user_id UUID NOT NULL,
+    theme_id TEXT NOT NULL,
+    seen INTEGER NOT NULL DEFAULT 0,
+    downloads INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, theme_id)
+);
+
+CREATE OR REPLACE FUNCTION count_theme_seen() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO user_theme_stats (user_id, theme_id, seen)
+    VALUES (NEW.user_id, NEW.theme_id, 1)
+    ON CONFLICT (user_id, theme_id) DO UPDATE
+    SET seen = user_theme_stats.seen + 1, updated_at = CURRENT_TIMESTAMP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER image_requests_count_theme_seen
+AFTER INSERT ON image_requests
+FOR EACH ROW EXECUTE FUNCTION count_theme_seen();
+
+CREATE OR REPLACE FUNCTION count_theme_download() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO user_theme_stats (user_id, theme_id, downloads)
+    SELECT ir.user_id, ir.theme_id, 1
+    FROM image_requests ir
+    WHERE ir.result_image_id = (NEW.metadata->>'result_image_id')::uuid
+    LIMIT 1
+    ON CONFLICT (user_id, theme_id) DO UPDATE
+    SET downloads = user_theme_stats.downloads + 1, updated_at = CURRENT_TIMESTAMP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER actions_count_theme_download
+AFTER INSERT ON actions
+FOR EACH ROW WHEN (NEW.action = 'download_image')
+EXECUTE FUNCTION count_theme_download();
+
+INSERT INTO user_theme_stats (user_id, theme_id, seen, downloads)
+SELECT ir.user_id, ir.theme_id, COUNT(*), COALESCE(SUM(d.downloads), 0)
+FROM image_requests ir
+LEFT JOIN (
+    SELECT (metadata->>'result_image_id')::uuid AS result_image_id, COUNT(*) AS downloads
+    FROM actions
+    WHERE action = 'download_image'
+    GROUP BY 1
+) d ON d.result_image_id = ir.result_image_id
+GROUP BY ir.user_id, ir.theme_id;
+
+COMMIT;
@@ -0,0 +1,93 @@
+-- Migration for databases created before the job state machine (job_states.py).
+-- Renames the worker-specific statuses: 'pending' was queued for process_images
+-- and claimed for background, and is re-queued as 'new' either way; 'completed'
+-- is now 'ready'. Jobs get a queue, so the test processor (background.py) no
+-- longer takes real jobs. Then adds the per-state counters and fills them.
+BEGIN;
+
+ALTER TABLE image_requests ADD COLUMN attempts SMALLINT NOT NULL DEFAULT 0;
+ALTER TABLE image_requests ADD COLUMN queue TEXT NOT NULL DEFAULT 'generate';
+
+DROP INDEX IF EXISTS image_requests_status_priority_idx;
+CREATE INDEX image_requests_queue_status_priority_idx ON image_requests (queue, status, priority, created_at);
+
+UPDATE image_requests SET status = 'new' WHERE status = 'pending';
+UPDATE image_requests SET status = 'ready' WHERE status = 'completed';
+
+ALTER TABLE image_requests ADD CONSTRAINT image_requests_status_check
+    CHECK (status IN ('new', 'retry', 'processing', 'ready', 'failed', 'cancelled', 'expired'));
+
+-- Results per (status, priority), so that job_states.counts() never scans
+-- image_requests. The trigger below only appends +1/-1 rows to
+-- job_state_deltas, which takes no row locks, so concurrent transitions can
+-- never deadlock on counters. fold_job_state_deltas() moves the deltas into
+-- job_state_counts; only one session folds at a time.
+CREATE TABLE job_state_counts (
+    status TEXT NOT NULL,
+    priority SMALLINT NOT NULL,
+    count BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (status, priority)
+);
+
+CREATE TABLE job_state_deltas (
+    status TEXT NOT NULL,
+    priority SMALLINT NOT NULL,
+    delta SMALLINT NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION count_job_states() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO job_state_deltas (status, priority, delta) VALUES (OLD.status, OLD.priority, -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO job_state_deltas (status, priority, delta) VALUES (NEW.status, NEW.priority, 1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER image_requests_count_job_states
+AFTER INSERT OR DELETE ON image_requests
+FOR EACH ROW EXECUTE FUNCTION count_job_states();
+
+CREATE TRIGGER image_requests_count_job_state_changes
+AFTER UPDATE OF status, priority ON image_requests
+FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status OR OLD.priority IS DISTINCT FROM NEW.priority)
+EXECUTE FUNCTION count_job_states();
+
+-- Adds the pending deltas to job_state_counts. Returns at once while another
+-- session is folding or reconciling.
+CREATE OR REPLACE PROCEDURE fold_job_state_deltas() AS $$
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('job_state_counts')) THEN
+        RETURN;
+    END IF;
+    WITH folded AS (
+        DELETE FROM job_state_deltas RETURNING status, priority, delta
+    )
+    INSERT INTO job_state_counts (status, priority, count)
+    SELECT status, priority, SUM(delta) FROM folded GROUP BY status, priority
+    ON CONFLICT (status, priority) DO UPDATE
+    SET count = job_state_counts.count + EXCLUDED.count;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Rebuilds job_state_counts after changes that skip row triggers, such as
+-- dropping partitions. Transitions wait on the lock while it runs.
+CREATE OR REPLACE PROCEDURE reconcile_job_state_counts() AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('job_state_counts'));
+    LOCK TABLE job_state_deltas IN EXCLUSIVE MODE;
+    DELETE FROM job_state_deltas;
+    DELETE FROM job_state_counts;
+    INSERT INTO job_state_counts (status, priority, count)
+    SELECT status, priority, COUNT(*)
+    FROM image_requests
+    GROUP BY status, priority;
+END;
+$$ LANGUAGE plpgsql;
+
+CALL reconcile_job_state_counts();
+
+COMMIT;
@@ -0,0 +1,64 @@
+-- One-off migration for databases created before image_requests was partitioned.
+-- Run inside a maintenance window: it copies every row of image_requests.
+BEGIN;
+
+ALTER TABLE image_requests RENAME TO image_requests_unpartitioned;
+ALTER TABLE image_requests_unpartitioned RENAME CONSTRAINT image_requests_pkey TO image_requests_unpartitioned_pkey;
+
+CREATE TABLE image_requests (
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
+    request_id UUID NOT NULL,
+    source_image_id UUID NOT NULL REFERENCES images(id),
+    theme_id TEXT NOT NULL,
+    result_image_id UUID NOT NULL,
+    user_id UUID NOT NULL REFERENCES users(user_id),
+    user_description TEXT,
+    status TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    completed_at TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE image_requests_default PARTITION OF image_requests DEFAULT;
+
+-- One partition per month that already has rows, plus the next two months.
+DO $$
+DECLARE
+    month_start DATE;
+BEGIN
+    FOR month_start IN
+        SELECT generate_series(
+            date_trunc('month', COALESCE(MIN(created_at), NOW())),
+            date_trunc('month', NOW()) + INTERVAL '2 months',
+            INTERVAL '1 month'
+        )::date
+        FROM image_requests_unpartitioned
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF image_requests FOR VALUES FROM (%L) TO (%L)',
+            'image_requests_' || to_char(month_start, 'YYYY_MM'),
+            month_start,
+            (month_start + INTERVAL '1 month')::date
+        );
+    END LOOP;
+END $$;
+
+INSERT INTO image_requests
+    (id, request_id, source_image_id, theme_id, result_image_id, user_id,
+     user_description, status, created_at)
+SELECT id, request_id, source_image_id, theme_id, result_image_id, user_id,
+       user_description, status, COALESCE(created_at, NOW())
+FROM image_requests_unpartitioned;
+
+DROP TABLE image_requests_unpartitioned;
+
+CREATE INDEX image_requests_result_image_id_idx ON image_requests (result_image_id);
+CREATE INDEX image_requests_status_created_at_idx ON image_requests (status, created_at);
+CREATE INDEX image_requests_source_image_id_idx ON image_requests (source_image_id);
+-- Recent completions, for measuring worker throughput.
+CREATE INDEX image_requests_completed_at_idx ON image_requests (completed_at) WHERE completed_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS actions_download_result_image_id_idx ON actions ((metadata->>'result_image_id'))
+    WHERE action = 'download_image';
+CREATE INDEX IF NOT EXISTS images_created_at_idx ON images (created_at);
+
+COMMIT;
@@ -8,62 +8,105 @@ It should be run as a background process or scheduled task.
 
 import logging
 import os
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from db import execute_query
-from helper import process_image_with_theme, theme_descriptions
+from db import execute_query, reset_primary_pin, use_primary, connection_scope, prewarm_pools
+from helper import process_image_with_theme, describe_image
+from theme_catalog import get_catalog
 from dotenv import load_dotenv
-import random
+from log_config import configure_logging, set_request_id
+from profiling import profile_job, install_signal_handler
+from cancellation import JobCancelled, ensure_not_cancelled
+import job_states
+import quality
 
 # Load environment variables
 load_dotenv()
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
-logger = logging.getLogger(__name__)
+configure_logging()
+# Named explicitly: run as a script, __name__ is '__main__' and LOG_SAMPLE_RATES would not match
+logger = logging.getLogger('process_images')
 
-def get_pending_requests(limit=10):
-    """Get a batch of pending image requests to process."""
+# Scheduling knobs; simulate.py sweeps them against a fake generation backend.
+WORKER_BATCH_SIZE = int(os.getenv('WORKER_BATCH_SIZE', '10'))
+WORKER_POLL_INTERVAL = float(os.getenv('WORKER_POLL_INTERVAL', '10'))
+WORKER_ERROR_SLEEP = float(os.getenv('WORKER_ERROR_SLEEP', '30'))
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', '1'))
+
+def get_pending_requests(limit=WORKER_BATCH_SIZE):
+    """Get a batch of pending image requests to process, full-resolution upgrades of previews last."""
     query = """
         SELECT ir.request_id, ir.source_image_id, ir.theme_id, ir.result_image_id, ir.user_id,
-               ir.user_description, i.data, i.mime_type
+               ir.user_description, i.data, i.mime_type, ir.quality_tier
         FROM image_requests ir
         JOIN images i ON ir.source_image_id = i.id
-        WHERE ir.status = 'pending'
-        ORDER BY ir.created_at
+        WHERE ir.queue = %s AND ir.status = ANY(%s)
+        ORDER BY ir.priority, ir.created_at
         LIMIT %s
     """
-    return execute_query(query, (limit,))
+    # Replicas may lag behind jobs other workers already picked up.
+    with use_primary():
+        return execute_query(query, (job_states.GENERATE, list(job_states.QUEUED), limit))
 
 def get_theme_description(theme_id):
-    """Get the theme description for a given theme ID."""
-    # In a real implementation, this would fetch from the database
-    # For now, we'll extract the theme index from the ID and use the list
-    try:
-        if theme_id.startswith('theme_'):
-            index = int(theme_id.split('_')[1])
-            if 0 <= index < len(theme_descriptions):
-                return theme_descriptions[index]
-    except (ValueError, IndexError):
-        pass
+    """
+    Get the theme description for a given theme ID from the theme catalog.
     
-    # Return a default theme if we couldn't find the specified one
-    return random.choice(theme_descriptions)
+    Raises:
+        LookupError: If the theme does not exist
+    """
+    theme_description = get_catalog().get(theme_id)
+    if theme_description is None:
+        raise LookupError(f"Unknown theme_id {theme_id}")
+    return theme_description
 
+def get_vision_description(source_image_id):
+    """
+    Get a stored Vision API description for a source image.
+
+    Falls back to the description of the earlier upload the image was
+    flagged as a near-duplicate of at ingest (metadata 'duplicate_of'), if
+    the same user uploaded it; another user's photo may only look similar.
+
+    Returns:
+        str or None: The description, or None if the image was never described
+    """
+    query = """
+        SELECT COALESCE(src.metadata->>'vision_description', dup.metadata->>'vision_description')
+        FROM images src
+        LEFT JOIN images dup ON dup.id = (src.metadata->>'duplicate_of')::uuid
+            AND dup.user_id = src.user_id
+        WHERE src.id = %s
+    """
+    result = execute_query(query, (source_image_id,))
+    return result[0][0] if result else None
+
+def save_vision_description(source_image_id, ai_description):
+    """Store a Vision API description on the source image for later jobs to reuse."""
+    query = """
+        UPDATE images
+        SET metadata = COALESCE(metadata, '{}'::jsonb) || jsonb_build_object('vision_description', %s::text)
+        WHERE id = %s
+    """
+    execute_query(query, (ai_description, source_image_id))
+
+@profile_job('process_images')
+@connection_scope()
 def process_request(request):
     """Process a single image request."""
-    request_id, source_image_id, theme_id, result_image_id, user_id, user_description, image_data, mime_type = request
+    request_id, source_image_id, theme_id, result_image_id, user_id, user_description, image_data, mime_type, tier = request
+    set_request_id(request_id)
+    reset_primary_pin()
     
     try:
-        logger.info(f"Processing request {request_id} with theme {theme_id}")
+        logger.info(f"Processing request {request_id} with theme {theme_id} ({tier})")
         
-        # Update status to processing
-        query = "UPDATE image_requests SET status = 'processing' WHERE result_image_id = %s"
-        execute_query(query, (result_image_id,))
+        # Update status to processing, unless the request was cancelled since it was listed
+        if not job_states.claim(result_image_id):
+            logger.info(f"Skipping result {result_image_id}, it was cancelled or claimed elsewhere")
+            return False
         
         # Create a BytesIO object from the image data
         image_file = BytesIO(image_data)
@@ -71,63 +114,109 @@ def process_request(request):
         # Get the theme description
         theme_description = get_theme_description(theme_id)
         
+        # Describe the source once and share it with the other themes of the
+        # request and with near-duplicate uploads
+        ai_description = get_vision_description(source_image_id)
+        if ai_description is None:
+            ai_description = describe_image(image_file, user_description or '')
+            save_vision_description(source_image_id, ai_description)
+        else:
+            logger.info(f"Reusing stored vision description for source image {source_image_id}")
+        
+        ensure_not_cancelled(result_image_id)
+        
         # Process the image with the theme
+        params = quality.generation_params(tier)
         result_image = process_image_with_theme(
             image_file,
             user_description or '',
-            theme_description
+            theme_description,
+            ai_description=ai_description,
+            model=params['model'],
+            size=params['size'],
+            max_prompt=params['max_prompt']
         )
         
-        # Save the result image to the database
-        result_data = result_image.getvalue()
-        query = """
-            INSERT INTO images (id, data, mime_type, created_at)
-            VALUES (%s, %s, %s, NOW())
-            ON CONFLICT (id) DO UPDATE 
-            SET data = EXCLUDED.data, 
-                mime_type = EXCLUDED.mime_type
-        """
-        execute_query(query, (result_image_id, result_data, 'image/jpeg'))
+        ensure_not_cancelled(result_image_id)
         
-        # Update the request status to completed
-        query = "UPDATE image_requests SET status = 'completed' WHERE result_image_id = %s"
-        execute_query(query, (result_image_id,))
+        # Save the result image and update the status in one statement
+        result_data = result_image.getvalue()
+        if tier == quality.PREVIEW and quality.QUALITY_UPGRADE_PREVIEWS:
+            # The preview is servable now; queue the full-resolution pass behind new work
+            stored = job_states.store_preview(result_image_id, result_data, 'image/jpeg', tier,
+                                              quality.FULL, quality.PRIORITY_UPGRADE)
+        else:
+            stored = job_states.finish(result_image_id, result_data, 'image/jpeg', tier)
+        if not stored:
+            logger.info(f"Dropped result {result_image_id}, it was cancelled while processing")
+            return False
         
         logger.info(f"Successfully processed request {request_id} with theme {theme_id}")
         return True
         
+    except JobCancelled:
+        logger.info(f"Abandoned cancelled request {request_id} with theme {theme_id}")
+        return False
+        
     except Exception as e:
         logger.error(f"Error processing request {request_id}: {str(e)}")
         
-        # Update the request status to failed
-        query = "UPDATE image_requests SET status = 'failed', error = %s WHERE result_image_id = %s"
-        execute_query(query, (str(e), result_image_id))
+        # Retry the request, or give up after JOB_MAX_ATTEMPTS
+        status = job_states.fail(result_image_id)
+        logger.info(f"Set request {request_id} status to '{status}'")
         
         return False
 
-def main():
-    """Main worker loop."""
-    logger.info("Starting image processing worker")
+def run_worker(batch_size=WORKER_BATCH_SIZE, poll_interval=WORKER_POLL_INTERVAL,
+               error_sleep=WORKER_ERROR_SLEEP, concurrency=WORKER_CONCURRENCY, stop_event=None):
+    """
+    Poll for pending requests and process them.
     
-    while True:
-        try:
-            # Get pending requests
-            pending_requests = get_pending_requests()
-            
-            if not pending_requests:
-                logger.info("No pending requests found, sleeping...")
-                time.sleep(10)  # Sleep for 10 seconds before checking again
-                continue
+    Args:
+        batch_size: Requests fetched per poll
+        poll_interval: Seconds to sleep when the queue is empty
+        error_sleep: Seconds to sleep after an error in the loop itself
+        concurrency: Requests of a batch processed at the same time
+        stop_event: threading.Event ending the loop once set; runs forever if None
+    """
+    stop_event = stop_event or threading.Event()
+    executor = ThreadPoolExecutor(concurrency, thread_name_prefix='process-images') if concurrency > 1 else None
+    try:
+        while not stop_event.is_set():
+            try:
+                # Get pending requests
+                pending_requests = get_pending_requests(batch_size)
                 
-            logger.info(f"Found {len(pending_requests)} pending requests")
-            
-            # Process each request
-            for request in pending_requests:
-                process_request(request)
+                if not pending_requests:
+                    logger.info("No pending requests found, sleeping...")
+                    stop_event.wait(poll_interval)
+                    continue
+                    
+                logger.info(f"Found {len(pending_requests)} pending requests")
                 
-        except Exception as e:
-            logger.error(f"Error in main worker loop: {str(e)}")
-            time.sleep(30)  # Sleep longer if there was an error
+                # Process each request
+                if executor:
+                    list(executor.map(process_request, pending_requests))
+                else:
+                    for request in pending_requests:
+                        process_request(request)
+                    
+            except Exception as e:
+                logger.error(f"Error in main worker loop: {str(e)}")
+                stop_event.wait(error_sleep)  # Sleep longer if there was an error
+    finally:
+        if executor:
+            executor.shutdown()
+
+def main():
+    """Main worker loop."""
+    logger.info("Starting image processing worker")
+    install_signal_handler()
+    try:
+        prewarm_pools()
+    except Exception as e:
+        logger.error(f"Error prewarming database connections: {str(e)}")
+    run_worker()
             
 if __name__ == "__main__":
     main() 
\ No newline at end of file
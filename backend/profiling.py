@@ -0,0 +1,227 @@
+"""
+Opt-in profiling for web requests and worker jobs.
+
+Two tools, both off unless configured:
+
+1. Per-request / per-job profiles. A web request carrying 'X-Profile: 1'
+   (when PROFILING_ENABLED is set), a random PROFILE_SAMPLE_RATE fraction of
+   requests, or a PROFILE_JOB_SAMPLE_RATE fraction of worker jobs run under
+   cProfile. Wall-clock timers around the expensive stages (image encoding,
+   OpenAI calls, execute_query) are recorded as well. Both are written to
+   PROFILE_DIR as <id>.prof and <id>.json.
+
+2. A sampling profiler that snapshots every thread's stack for N seconds
+   and returns collapsed stacks (flamegraph.pl / speedscope format). The
+   web app exposes it as an admin endpoint; workers run it on SIGUSR1 and
+   write the result to PROFILE_DIR.
+
+When no profile is active, stage() hands back a shared no-op context
+manager, so the instrumented code paths pay one ContextVar lookup.
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import json
+import logging
+import math
+import os
+import random
+import signal
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_JOB_SAMPLE_RATE = float(os.getenv('PROFILE_JOB_SAMPLE_RATE', '0'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/multiverse-profiles')
+PROFILE_SIGNAL_SECONDS = float(os.getenv('PROFILE_SIGNAL_SECONDS', '30'))
+MAX_SAMPLE_SECONDS = 120
+MAX_SAMPLE_INTERVAL = 1.0
+
+_active = contextvars.ContextVar('active_profile', default=None)
+_NOOP = contextlib.nullcontext()
+
+
+class Profile:
+    """Stage timings, and optionally a cProfile run, for one request or job."""
+
+    def __init__(self, label, use_cprofile=True):
+        self.id = f"{label}-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.label = label
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.profiler = None
+        if use_cprofile:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                self.profiler = profiler
+            except ValueError:
+                # Python 3.12+ allows one cProfile per process; keep the stage timers
+                logger.info(f"cProfile already active, {self.id} records stage timings only")
+
+    def add(self, name, seconds):
+        count, total = self.stages.get(name, (0, 0.0))
+        self.stages[name] = (count + 1, total + seconds)
+
+    def finish(self):
+        """Stop profiling and write the results to PROFILE_DIR."""
+        elapsed = time.perf_counter() - self.started
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, self.id)
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(base + '.prof')
+        with open(base + '.json', 'w') as f:
+            json.dump({
+                'id': self.id,
+                'label': self.label,
+                'total_ms': round(elapsed * 1000, 3),
+                'stages': {
+                    name: {'count': count, 'total_ms': round(total * 1000, 3)}
+                    for name, (count, total) in sorted(self.stages.items(), key=lambda s: -s[1][1])
+                },
+            }, f, indent=2)
+        logger.info(f"Wrote profile {self.id} ({elapsed * 1000:.0f} ms)")
+
+
+class _StageTimer:
+    __slots__ = ('profile', 'name', 'started')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profile.add(self.name, time.perf_counter() - self.started)
+        return False
+
+
+def stage(name):
+    """Time a block under name if a profile is active, otherwise do nothing."""
+    profile = _active.get()
+    if profile is None:
+        return _NOOP
+    return _StageTimer(profile, name)
+
+
+def start_profile(label):
+    """
+    Start profiling the current context.
+
+    Returns:
+        tuple: (Profile, token) to pass to finish_profile
+    """
+    profile = Profile(label)
+    return profile, _active.set(profile)
+
+
+def finish_profile(profile, token):
+    """Stop a profile started with start_profile and write it out."""
+    try:
+        _active.reset(token)
+    except ValueError:
+        _active.set(None)
+    try:
+        profile.finish()
+    except Exception as e:
+        logger.error(f"Error writing profile {profile.id}: {str(e)}")
+
+
+def should_profile_request(headers):
+    """Whether a web request should be profiled, from its headers and PROFILE_SAMPLE_RATE."""
+    if PROFILING_ENABLED and headers.get('X-Profile') == '1':
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def profile_job(label):
+    """Decorator profiling a PROFILE_JOB_SAMPLE_RATE fraction of calls of a worker job."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if PROFILE_JOB_SAMPLE_RATE <= 0 or random.random() >= PROFILE_JOB_SAMPLE_RATE:
+                return func(*args, **kwargs)
+            profile, token = start_profile(label)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                finish_profile(profile, token)
+        return wrapper
+    return decorator
+
+
+def _frame_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def sample_stacks(seconds, interval=0.01):
+    """
+    Sample the stacks of every other thread in this process.
+
+    Args:
+        seconds: How long to sample for (capped at MAX_SAMPLE_SECONDS)
+        interval: Seconds between samples (capped at MAX_SAMPLE_INTERVAL)
+
+    Returns:
+        str: Collapsed stacks, one 'thread;frame;frame count' line per distinct stack
+
+    Raises:
+        ValueError: If seconds or interval is not a positive finite number; an
+        interval of 0 would spin holding the GIL
+    """
+    seconds, interval = float(seconds), float(interval)
+    if not (math.isfinite(seconds) and math.isfinite(interval) and seconds > 0 and interval > 0):
+        raise ValueError("seconds and interval must be positive finite numbers")
+    seconds = min(seconds, MAX_SAMPLE_SECONDS)
+    interval = min(interval, MAX_SAMPLE_INTERVAL)
+    me = threading.get_ident()
+    counts = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            counts[f"{names.get(ident, ident)};{_frame_stack(frame)}"] += 1
+        time.sleep(interval)
+    return ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+def _sample_to_file(seconds):
+    path = os.path.join(PROFILE_DIR, f"stacks-{os.getpid()}-{time.strftime('%Y%m%dT%H%M%S')}.txt")
+    try:
+        stacks = sample_stacks(seconds)
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(stacks)
+        logger.info(f"Wrote stack samples to {path}")
+    except Exception as e:
+        logger.error(f"Error sampling stacks: {str(e)}")
+
+
+def install_signal_handler(seconds=PROFILE_SIGNAL_SECONDS):
+    """
+    Sample stacks for `seconds` whenever the process receives SIGUSR1.
+
+    For processes without an HTTP server: `kill -USR1 <pid>` and collect the
+    file from PROFILE_DIR.
+    """
+    def handler(signum, frame):
+        threading.Thread(target=_sample_to_file, args=(seconds,), name='stack-sampler', daemon=True).start()
+    signal.signal(signal.SIGUSR1, handler)
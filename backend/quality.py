@@ -0,0 +1,58 @@
+"""
+Generation quality tiers.
+
+Under load /api/create queues 'preview' jobs instead of 'full' ones. A
+preview is a cheaper, smaller generation that the user sees quickly. Once
+it is stored, the worker requeues the same row as a 'full' job at a lower
+priority, so new uploads are served before upgrades. image_requests.stored_tier
+records which tier is currently in the images table, and get_image serves
+whatever is stored.
+"""
+
+import os
+
+PREVIEW = 'preview'
+FULL = 'full'
+
+# Lower values are claimed first by the worker.
+PRIORITY_NEW = 0
+PRIORITY_UPGRADE = 1
+
+TIERS = {
+    PREVIEW: {
+        'model': os.getenv('PREVIEW_MODEL', 'dall-e-2'),
+        'size': os.getenv('PREVIEW_SIZE', '512x512'),
+        # dall-e-2 rejects prompts over 1000 characters
+        'max_prompt': int(os.getenv('PREVIEW_MAX_PROMPT', '1000')),
+    },
+    FULL: {
+        'model': os.getenv('FULL_MODEL', 'dall-e-3'),
+        'size': os.getenv('FULL_SIZE', '1024x1024'),
+        'max_prompt': int(os.getenv('FULL_MAX_PROMPT', '4000')),
+    },
+}
+
+# Queue previews once new jobs would wait longer than this many seconds; 0 disables tiers.
+QUALITY_PREVIEW_WAIT = float(os.getenv('QUALITY_PREVIEW_WAIT', '60'))
+# Requeue previews for a full-resolution pass.
+QUALITY_UPGRADE_PREVIEWS = os.getenv('QUALITY_UPGRADE_PREVIEWS', '1').lower() in ('1', 'true', 'yes')
+
+
+def choose_tier(estimated_wait):
+    """
+    Pick the tier for new jobs from the estimated queue wait.
+
+    Args:
+        estimated_wait: Seconds until newly queued jobs would be done
+
+    Returns:
+        str: PREVIEW when the backlog is past QUALITY_PREVIEW_WAIT, else FULL
+    """
+    if QUALITY_PREVIEW_WAIT > 0 and estimated_wait > QUALITY_PREVIEW_WAIT:
+        return PREVIEW
+    return FULL
+
+
+def generation_params(tier):
+    """Model, size and prompt limit for a tier; unknown tiers get FULL."""
+    return TIERS.get(tier, TIERS[FULL])
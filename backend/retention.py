@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+"""
+Retention and Archival Job
+
+Keeps images and image_requests from growing forever. Each run:
+1. Creates the upcoming monthly partitions of image_requests
+2. Deletes generated images nobody downloaded after RETENTION_UNDOWNLOADED_DAYS
+3. Moves source images older than RETENTION_ARCHIVE_SOURCE_DAYS to ARCHIVE_DIR
+4. Drops image_requests partitions older than RETENTION_REQUEST_MONTHS
+5. Deletes /api/create idempotency keys older than IDEMPOTENCY_WINDOW
+
+Work is done in batches of RETENTION_BATCH_SIZE rows, each in its own short
+transaction, with RETENTION_BATCH_PAUSE seconds between batches so the job
+never holds locks on the hot tables for long. A policy set to 0 is disabled.
+
+Run once (e.g. from cron):     python retention.py
+Run continuously:              python retention.py --loop
+"""
+
+import json
+import logging
+import mimetypes
+import os
+import sys
+import time
+from datetime import date, datetime, timezone
+from db import execute_query, get_db_connection, release_db_connection, maintenance_connection
+from dotenv import load_dotenv
+from log_config import configure_logging
+import idempotency
+import job_states
+
+# Load environment variables
+load_dotenv()
+
+# Configure logging
+configure_logging()
+logger = logging.getLogger(__name__)
+
+RETENTION_UNDOWNLOADED_DAYS = int(os.getenv('RETENTION_UNDOWNLOADED_DAYS', '30'))
+RETENTION_ARCHIVE_SOURCE_DAYS = int(os.getenv('RETENTION_ARCHIVE_SOURCE_DAYS', '0'))
+RETENTION_REQUEST_MONTHS = int(os.getenv('RETENTION_REQUEST_MONTHS', '0'))
+RETENTION_PARTITIONS_AHEAD = int(os.getenv('RETENTION_PARTITIONS_AHEAD', '2'))
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', '200'))
+RETENTION_BATCH_PAUSE = float(os.getenv('RETENTION_BATCH_PAUSE', '0.5'))
+# Longest a partition change waits for its lock on image_requests before giving up until the next run.
+RETENTION_LOCK_TIMEOUT_MS = int(os.getenv('RETENTION_LOCK_TIMEOUT_MS', '2000'))
+RETENTION_INTERVAL = int(os.getenv('RETENTION_INTERVAL', '3600'))
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', '')
+
+# Statuses that mean a worker may still read the source image.
+ACTIVE_STATUSES = job_states.UNFINISHED
+
+
+def _add_months(day, months):
+    month_index = day.year * 12 + day.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(month_start):
+    """Name of the image_requests partition covering the given month."""
+    return f"image_requests_{month_start:%Y_%m}"
+
+
+def _split_default_partition(name, start, end):
+    """
+    Create partition name for [start, end) when the default partition already
+    holds rows in that range, which CREATE TABLE ... PARTITION OF rejects.
+
+    The default partition is detached, its rows in the range are moved into
+    the new table, and both are attached. Detached tables have no triggers,
+    so the move does not touch job_state_counts or user_theme_stats. Inserts
+    into image_requests wait for the transaction. Postgres can't detach a
+    default partition CONCURRENTLY, so the lock is only waited for up to
+    RETENTION_LOCK_TIMEOUT_MS.
+
+    Returns:
+        int: Rows moved out of the default partition
+    """
+    with maintenance_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SET LOCAL lock_timeout = %s", (RETENTION_LOCK_TIMEOUT_MS,))
+            cursor.execute("ALTER TABLE image_requests DETACH PARTITION image_requests_default")
+            cursor.execute(f"CREATE TABLE {name} (LIKE image_requests INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+            cursor.execute(f"""
+                WITH moved AS (
+                    DELETE FROM image_requests_default
+                    WHERE created_at >= %s AND created_at < %s
+                    RETURNING *
+                )
+                INSERT INTO {name} SELECT * FROM moved
+            """, (start.isoformat(), end.isoformat()))
+            moved = cursor.rowcount
+            cursor.execute(
+                f"ALTER TABLE image_requests ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+                (start.isoformat(), end.isoformat())
+            )
+            cursor.execute("ALTER TABLE image_requests ATTACH PARTITION image_requests_default DEFAULT")
+        conn.commit()
+        return moved
+
+
+def ensure_partitions(months_ahead=RETENTION_PARTITIONS_AHEAD):
+    """
+    Create monthly image_requests partitions from this month to months_ahead.
+
+    Rows the default partition already holds for a new month are moved into
+    its partition.
+
+    Returns:
+        list: Names of the partitions that were created
+    """
+    created = []
+    this_month = datetime.now(timezone.utc).date().replace(day=1)
+    for offset in range(months_ahead + 1):
+        start = _add_months(this_month, offset)
+        end = _add_months(start, 1)
+        name = partition_name(start)
+        exists = execute_query("SELECT to_regclass(%s)", (name,))
+        if exists and exists[0][0]:
+            continue
+        try:
+            stranded = execute_query(
+                "SELECT EXISTS (SELECT 1 FROM image_requests_default WHERE created_at >= %s AND created_at < %s)",
+                (start.isoformat(), end.isoformat())
+            )
+            if stranded and stranded[0][0]:
+                moved = _split_default_partition(name, start, end)
+                logger.info(f"Created partition {name}, moved {moved} rows out of the default partition")
+            else:
+                execute_query(
+                    f"CREATE TABLE {name} PARTITION OF image_requests FOR VALUES FROM (%s) TO (%s)",
+                    (start.isoformat(), end.isoformat())
+                )
+                logger.info(f"Created partition {name}")
+            created.append(name)
+        except Exception as e:
+            logger.error(f"Could not create partition {name}: {str(e)}")
+    return created
+
+
+def purge_undownloaded_results(days=RETENTION_UNDOWNLOADED_DAYS, batch_size=RETENTION_BATCH_SIZE):
+    """
+    Delete generated images older than days that were never downloaded.
+
+    The matching image_requests rows are kept but marked 'expired', so status
+    polling reports why the image is gone.
+
+    Returns:
+        tuple: (rows deleted, bytes of image data deleted)
+    """
+    query = """
+        WITH doomed AS (
+            SELECT i.id
+            FROM images i
+            JOIN image_requests ir ON ir.result_image_id = i.id
+            WHERE i.created_at < NOW() - make_interval(days => %s)
+              AND NOT EXISTS (
+                  SELECT 1 FROM actions a
+                  WHERE a.action = 'download_image'
+                    AND a.metadata->>'result_image_id' = i.id::text
+              )
+            LIMIT %s
+            FOR UPDATE OF i SKIP LOCKED
+        ), expired AS (
+            UPDATE image_requests SET status = %s, stored_tier = NULL
+            WHERE result_image_id IN (SELECT id FROM doomed)
+        )
+        DELETE FROM images
+        WHERE id IN (SELECT id FROM doomed)
+        RETURNING octet_length(data)
+    """
+    rows_deleted = 0
+    bytes_deleted = 0
+    while True:
+        result = execute_query(query, (days, batch_size, job_states.EXPIRED), fetch=True)
+        if not result:
+            break
+        rows_deleted += len(result)
+        bytes_deleted += sum(row[0] or 0 for row in result)
+        logger.info(f"Purged {len(result)} undownloaded results")
+        if len(result) < batch_size:
+            break
+        time.sleep(RETENTION_BATCH_PAUSE)
+    return rows_deleted, bytes_deleted
+
+
+ARCHIVABLE_CONDITIONS = """
+    i.created_at < NOW() - make_interval(days => %s)
+    AND octet_length(i.data) > 0
+    AND (i.metadata IS NULL OR NOT i.metadata ? 'archived_path')
+    AND EXISTS (SELECT 1 FROM image_requests ir WHERE ir.source_image_id = i.id)
+    AND NOT EXISTS (
+        SELECT 1 FROM image_requests ir
+        WHERE ir.source_image_id = i.id AND ir.status = ANY(%s)
+    )
+"""
+
+
+def _archive_image(image_id, days, archive_dir):
+    """
+    Move one source image to archive_dir, in its own transaction.
+
+    Only this image's blob is in memory and only its row is locked while the
+    file is written.
+
+    Returns:
+        int or None: Bytes archived, None if the image no longer qualifies or is locked
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT i.data, i.mime_type, i.created_at
+                FROM images i
+                WHERE i.id = %s AND {ARCHIVABLE_CONDITIONS}
+                FOR UPDATE OF i SKIP LOCKED
+            """, (image_id, days, list(ACTIVE_STATUSES)))
+            row = cursor.fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+            data, mime_type, created_at = row
+            extension = mimetypes.guess_extension(mime_type or '') or '.bin'
+            directory = os.path.join(archive_dir, f"{created_at:%Y}", f"{created_at:%m}")
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{image_id}{extension}")
+            with open(path, 'wb') as f:
+                f.write(bytes(data))
+            cursor.execute(
+                "UPDATE images SET data = ''::bytea, metadata = COALESCE(metadata, '{}'::jsonb) || %s::jsonb WHERE id = %s",
+                (json.dumps({'archived_path': path, 'archived_bytes': len(data)}), image_id)
+            )
+        conn.commit()
+        return len(data)
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+
+def _archive_batch(days, batch_size, archive_dir):
+    """
+    Archive up to batch_size source images.
+
+    Returns:
+        tuple: (images looked at, images archived, bytes archived)
+    """
+    # Only ids here; blobs are read one at a time by _archive_image
+    image_ids = execute_query(f"""
+        SELECT i.id FROM images i
+        WHERE {ARCHIVABLE_CONDITIONS}
+        LIMIT %s
+    """, (days, list(ACTIVE_STATUSES), batch_size)) or []
+
+    archived = 0
+    bytes_archived = 0
+    for (image_id,) in image_ids:
+        size = _archive_image(image_id, days, archive_dir)
+        if size is not None:
+            archived += 1
+            bytes_archived += size
+    return len(image_ids), archived, bytes_archived
+
+
+def archive_source_images(days=RETENTION_ARCHIVE_SOURCE_DAYS, batch_size=RETENTION_BATCH_SIZE, archive_dir=ARCHIVE_DIR):
+    """
+    Move old source images to archive_dir and clear their data column.
+
+    Only images with no request still waiting on them are archived. The file
+    path is recorded in images.metadata under 'archived_path'.
+
+    Returns:
+        tuple: (images archived, bytes moved out of the database)
+    """
+    if not archive_dir:
+        logger.warning("ARCHIVE_DIR is not set, skipping source image archival")
+        return 0, 0
+
+    images_archived = 0
+    bytes_archived = 0
+    while True:
+        seen, count, size = _archive_batch(days, batch_size, archive_dir)
+        images_archived += count
+        bytes_archived += size
+        if count:
+            logger.info(f"Archived {count} source images ({size} bytes)")
+        # Stop once a batch is short, or made no progress because every image was locked
+        if seen < batch_size or count == 0:
+            break
+        time.sleep(RETENTION_BATCH_PAUSE)
+    return images_archived, bytes_archived
+
+
+def _has_default_partition():
+    result = execute_query(
+        "SELECT partdefid <> 0 FROM pg_partitioned_table WHERE partrelid = 'image_requests'::regclass"
+    )
+    return bool(result and result[0][0])
+
+
+def _detach_partition(name):
+    """
+    Detach partition name from image_requests.
+
+    Uses DETACH PARTITION ... CONCURRENTLY, which doesn't block queries on
+    image_requests. Postgres refuses it while a default partition exists;
+    then a plain DETACH waits at most RETENTION_LOCK_TIMEOUT_MS for its lock.
+    """
+    if not _has_default_partition():
+        with maintenance_connection(autocommit=True) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f"ALTER TABLE image_requests DETACH PARTITION {name} CONCURRENTLY")
+        return
+    with maintenance_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SET LOCAL lock_timeout = %s", (RETENTION_LOCK_TIMEOUT_MS,))
+            cursor.execute(f"ALTER TABLE image_requests DETACH PARTITION {name}")
+        conn.commit()
+
+
+def _delete_images_in_batches(query, params, batch_size):
+    """
+    Run a DELETE ... RETURNING octet_length(data), metadata->>'archived_path'
+    batch by batch, removing archived files along the way.
+
+    Returns:
+        tuple: (images deleted, bytes freed)
+    """
+    deleted = 0
+    bytes_freed = 0
+    while True:
+        result = execute_query(query, params + (batch_size,), fetch=True) or []
+        for size, archived_path in result:
+            bytes_freed += size or 0
+            if archived_path:
+                try:
+                    bytes_freed += os.path.getsize(archived_path)
+                    os.remove(archived_path)
+                except OSError as e:
+                    logger.warning(f"Could not remove archived image {archived_path}: {str(e)}")
+        deleted += len(result)
+        if len(result) < batch_size:
+            return deleted, bytes_freed
+        time.sleep(RETENTION_BATCH_PAUSE)
+
+
+def _purge_partition_results(name, batch_size):
+    """Delete the result images of every row in partition name."""
+    return _delete_images_in_batches(f"""
+        DELETE FROM images
+        WHERE id IN (
+            SELECT i.id FROM {name} ir
+            JOIN images i ON i.id = ir.result_image_id
+            LIMIT %s
+            FOR UPDATE OF i SKIP LOCKED
+        )
+        RETURNING octet_length(data), metadata->>'archived_path'
+    """, (), batch_size)
+
+
+def _purge_orphaned_images(start, end, batch_size):
+    """Delete images created in [start, end) that no image_requests row refers to anymore."""
+    return _delete_images_in_batches("""
+        DELETE FROM images
+        WHERE id IN (
+            SELECT i.id FROM images i
+            WHERE i.created_at >= %s AND i.created_at < %s
+              AND NOT EXISTS (SELECT 1 FROM image_requests ir WHERE ir.source_image_id = i.id)
+              AND NOT EXISTS (SELECT 1 FROM image_requests ir WHERE ir.result_image_id = i.id)
+            LIMIT %s
+            FOR UPDATE OF i SKIP LOCKED
+        )
+        RETURNING octet_length(data), metadata->>'archived_path'
+    """, (start.isoformat(), end.isoformat()), batch_size)
+
+
+def drop_expired_partitions(months=RETENTION_REQUEST_MONTHS, batch_size=RETENTION_BATCH_SIZE):
+    """
+    Drop image_requests partitions whose whole month is older than months.
+
+    The images the rows refer to would be unreachable afterwards, since the
+    other policies find images through image_requests. Result images are
+    deleted before the partition is dropped, and source images (and their
+    archived files) once no remaining row refers to them.
+
+    Returns:
+        tuple: (partitions dropped, bytes freed on disk)
+    """
+    cutoff = _add_months(datetime.now(timezone.utc).date().replace(day=1), -months)
+    partitions = execute_query("""
+        SELECT c.relname, pg_total_relation_size(c.oid)
+        FROM pg_inherits inh
+        JOIN pg_class c ON c.oid = inh.inhrelid
+        WHERE inh.inhparent = 'image_requests'::regclass
+          AND c.relname ~ '^image_requests_[0-9]{4}_[0-9]{2}$'
+        ORDER BY c.relname
+    """) or []
+
+    dropped = 0
+    bytes_freed = 0
+    for name, size in partitions:
+        year, month = int(name[-7:-3]), int(name[-2:])
+        # A partition is expired once the month after it starts before the cutoff.
+        if _add_months(date(year, month, 1), 1) > cutoff:
+            continue
+        month_start = date(year, month, 1)
+        results, results_bytes = _purge_partition_results(name, batch_size)
+        try:
+            _detach_partition(name)
+        except Exception as e:
+            logger.warning(f"Could not detach partition {name}, retrying next run: {str(e)}")
+            continue
+        execute_query(f"DROP TABLE {name}")
+        sources, sources_bytes = _purge_orphaned_images(month_start, _add_months(month_start, 1), batch_size)
+        dropped += 1
+        bytes_freed += size + results_bytes + sources_bytes
+        logger.info(f"Dropped partition {name} ({size} bytes) with {results} result and {sources} source images")
+    if dropped:
+        # Dropped rows never fire the per-row counter trigger
+        job_states.reconcile_counts()
+    return dropped, bytes_freed
+
+
+def run_retention():
+    """
+    Run every enabled policy once.
+
+    Returns:
+        dict: What was removed, with bytes reclaimed per policy and in total
+    """
+    started = time.monotonic()
+    report = {'partitions_created': ensure_partitions()}
+
+    if RETENTION_UNDOWNLOADED_DAYS > 0:
+        report['results_purged'], report['results_bytes'] = purge_undownloaded_results()
+    if RETENTION_ARCHIVE_SOURCE_DAYS > 0:
+        report['sources_archived'], report['sources_bytes'] = archive_source_images()
+    if RETENTION_REQUEST_MONTHS > 0:
+        report['partitions_dropped'], report['partitions_bytes'] = drop_expired_partitions()
+    report['idempotency_keys_purged'] = idempotency.purge_expired()
+
+    report['bytes_reclaimed'] = sum(v for k, v in report.items() if k.endswith('_bytes'))
+    report['duration_seconds'] = round(time.monotonic() - started, 2)
+    logger.info(f"Retention run complete: {json.dumps(report)}")
+    return report
+
+
+def main():
+    """Run the retention job once, or forever with --loop."""
+    if '--loop' not in sys.argv:
+        run_retention()
+        return
+
+    logger.info("Starting retention loop")
+    while True:
+        try:
+            run_retention()
+        except Exception as e:
+            logger.error(f"Error in retention loop: {str(e)}")
+        time.sleep(RETENTION_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
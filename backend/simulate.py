@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+Worker Throughput Simulator
+
+Runs the real worker loop (process_images.run_worker or background.run_worker)
+against a local Postgres, with the OpenAI calls swapped for a fake backend
+that sleeps for a sampled latency and fails at a configured rate. For every
+combination of --concurrency, --batch-size and --poll-interval it queues a
+fresh set of jobs, runs the workers until the queue drains (or --timeout),
+and reports:
+
+- throughput: finished jobs per second
+- queue wait: seconds from a job being queued to a worker starting on it
+- turnaround: seconds from a job being queued to it finishing
+- DB statements per second and per job, from db.query_count()
+
+Point it at a disposable database only. It creates and deletes its own user,
+images and image_requests, and refuses to start while other users have
+unfinished jobs, since the workers would pick those up too. Themes must be
+loaded (python theme.py) for process_images.
+
+Example:
+    python simulate.py --worker process_images --jobs 240 \\
+        --concurrency 1,4,8 --batch-size 5,10,20 --poll-interval 1,10 \\
+        --latency lognormal:8,0.4 --failure-rate 0.02
+"""
+
+import argparse
+import csv
+import itertools
+import logging
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from io import BytesIO
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from db import execute_query, query_count, DB_POOL_MAX
+from log_config import configure_logging, get_request_id
+from theme_catalog import get_catalog
+import background
+import job_states
+import process_images
+
+configure_logging()
+logger = logging.getLogger(__name__)
+
+SIM_USER_ID = '00000000-0000-4000-8000-00000000051a'
+SOURCE_IMAGE_BYTES = b'simulated source image'
+UNFINISHED_STATUSES = job_states.UNFINISHED
+# Failed jobs are retried up to JOB_MAX_ATTEMPTS times before they end up here.
+FINISHED_STATUSES = (job_states.READY, job_states.FAILED)
+
+# Worker module and the queue it takes jobs from.
+WORKERS = {
+    'process_images': (process_images, job_states.GENERATE),
+    'background': (background, job_states.TEST),
+}
+
+
+def parse_distribution(spec):
+    """
+    Parse a latency distribution.
+
+    Args:
+        spec: 'fixed:S', 'uniform:A,B', 'exp:MEAN', 'normal:MEAN,SD' or
+            'lognormal:MEDIAN,SIGMA', in seconds
+
+    Returns:
+        callable: Taking a random.Random and returning a non-negative sample
+    """
+    kind, _, args = spec.partition(':')
+    try:
+        values = [float(v) for v in args.split(',')] if args else []
+        if kind == 'fixed' and len(values) == 1:
+            return lambda rng: values[0]
+        if kind == 'uniform' and len(values) == 2:
+            return lambda rng: rng.uniform(values[0], values[1])
+        if kind == 'exp' and len(values) == 1:
+            return lambda rng: rng.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+        if kind == 'normal' and len(values) == 2:
+            return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+        if kind == 'lognormal' and len(values) == 2:
+            return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"Invalid distribution '{spec}'")
+
+
+def parse_list(cast):
+    """argparse type for a comma separated list of values."""
+    def parse(value):
+        try:
+            return [cast(v) for v in value.split(',') if v]
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Invalid list '{value}'")
+    return parse
+
+
+class FakeBackend:
+    """
+    Stand-in for the OpenAI calls made by the workers.
+
+    Also records when each job first reached the backend, keyed by the
+    request id the worker binds for the job, as the end of its queue wait.
+    """
+
+    def __init__(self, latency, vision_latency, failure_rate, result_bytes, seed=None):
+        self.latency = latency
+        self.vision_latency = vision_latency
+        self.failure_rate = failure_rate
+        self.result = b'\x89PNG\r\n\x1a\n' + bytes(max(0, result_bytes - 8))
+        self.started = {}
+        self.calls = 0
+        self.failures = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.started.clear()
+            self.calls = 0
+            self.failures = 0
+
+    def _call(self, distribution):
+        now = time.time()
+        with self._lock:
+            self.started.setdefault(get_request_id(), now)
+            self.calls += 1
+            delay = distribution(self._rng)
+            fail = self._rng.random() < self.failure_rate
+            if fail:
+                self.failures += 1
+        time.sleep(delay)
+        if fail:
+            raise RuntimeError("Simulated backend failure")
+
+    def describe_image(self, image_file, user_description, client=None):
+        self._call(self.vision_latency)
+        return f"Simulated description of {user_description}"
+
+    def process_image_with_theme(self, image_file, user_description, theme_description, ai_description=None, **kwargs):
+        if ai_description is None:
+            self.describe_image(image_file, user_description)
+        self._call(self.latency)
+        return BytesIO(self.result)
+
+    def fetch_test_image(self):
+        self._call(self.latency)
+        return self.result, 'image/png'
+
+    def install(self):
+        """Swap the backend into the worker modules."""
+        process_images.describe_image = self.describe_image
+        process_images.process_image_with_theme = self.process_image_with_theme
+        background.fetch_test_image = self.fetch_test_image
+
+
+def check_database_is_idle():
+    """Refuse to run while the workers would pick up somebody else's jobs."""
+    query = "SELECT COUNT(*) FROM image_requests WHERE status = ANY(%s) AND user_id <> %s"
+    others = execute_query(query, (list(UNFINISHED_STATUSES), SIM_USER_ID))[0][0]
+    if others:
+        raise SystemExit(f"Found {others} unfinished jobs of other users; run the simulator on a disposable database")
+
+
+def cleanup():
+    """Delete everything the simulator created."""
+    execute_query("DELETE FROM image_requests WHERE user_id = %s", (SIM_USER_ID,))
+    execute_query("DELETE FROM images WHERE user_id = %s", (SIM_USER_ID,))
+    # Filled by triggers on image_requests inserts, which deletes don't undo
+    execute_query("DELETE FROM user_theme_stats WHERE user_id = %s", (SIM_USER_ID,))
+
+
+def seed_jobs(jobs, queue, themes_per_request, arrival_rate, stop_event):
+    """
+    Queue the jobs of one run, all at once or at arrival_rate jobs per second.
+
+    Jobs are grouped themes_per_request to a source image, like /api/create
+    does, so process_images shares one vision description per group. Each
+    job gets its own request_id so its queue wait can be told apart.
+
+    Returns:
+        int: Statements run, to take out of the run's query count
+    """
+    theme_ids = get_catalog().sample(themes_per_request)
+    if not theme_ids:
+        raise SystemExit("No themes in the database; load them with python theme.py")
+
+    statements = 0
+    source_image_id = None
+    interval = 1 / arrival_rate if arrival_rate > 0 else 0
+    next_at = time.monotonic()
+    for i in range(jobs):
+        if stop_event.is_set():
+            break
+        if i % themes_per_request == 0:
+            source_image_id = str(uuid.uuid4())
+            execute_query(
+                "INSERT INTO images (id, user_id, data, mime_type) VALUES (%s, %s, %s, %s)",
+                (source_image_id, SIM_USER_ID, SOURCE_IMAGE_BYTES, 'image/jpeg')
+            )
+            statements += 1
+        if interval:
+            stop_event.wait(max(0, next_at - time.monotonic()))
+            next_at += interval
+        execute_query("""
+            INSERT INTO image_requests
+            (request_id, source_image_id, theme_id, result_image_id, user_id, user_description, status, queue,
+             created_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())
+        """, (str(uuid.uuid4()), source_image_id, theme_ids[i % len(theme_ids)], str(uuid.uuid4()),
+              SIM_USER_ID, 'simulated upload', job_states.NEW, queue))
+        statements += 1
+    return statements
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_once(worker, backend, args, concurrency, batch_size, poll_interval):
+    """
+    Simulate one parameter combination.
+
+    Returns:
+        dict: Settings and measurements of the run
+    """
+    module, queue = WORKERS[worker]
+    cleanup()
+    backend.reset()
+
+    stop_feeding = threading.Event()
+    seeded = {}
+    feeder = threading.Thread(
+        target=lambda: seeded.update(statements=seed_jobs(
+            args.jobs, queue, args.themes_per_request, args.arrival_rate, stop_feeding
+        )),
+        name='sim-feeder', daemon=True
+    )
+    # With all jobs queued up front, start the clock once they are in
+    if args.arrival_rate <= 0:
+        feeder.run()
+    queries_before = query_count()
+    started = time.monotonic()
+    if args.arrival_rate > 0:
+        feeder.start()
+
+    stop_workers = threading.Event()
+    threads = [
+        threading.Thread(
+            target=module.run_worker,
+            kwargs={
+                'batch_size': batch_size,
+                'poll_interval': poll_interval,
+                'error_sleep': args.error_sleep,
+                'concurrency': concurrency,
+                'stop_event': stop_workers,
+            },
+            name=f"sim-worker-{n}", daemon=True
+        )
+        for n in range(args.workers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    monitor_queries = 0
+    drained_at = None
+    remaining = None
+    while time.monotonic() - started < args.timeout:
+        time.sleep(args.monitor_interval)
+        remaining = execute_query(
+            "SELECT COUNT(*) FROM image_requests WHERE user_id = %s AND status = ANY(%s)",
+            (SIM_USER_ID, list(UNFINISHED_STATUSES))
+        )[0][0]
+        monitor_queries += 1
+        if remaining == 0 and not feeder.is_alive():
+            drained_at = time.monotonic()
+            break
+
+    elapsed = (drained_at or time.monotonic()) - started
+    stop_feeding.set()
+    stop_workers.set()
+    if args.arrival_rate > 0:
+        feeder.join()
+    worker_queries = query_count() - queries_before - monitor_queries
+    if args.arrival_rate > 0:
+        worker_queries -= seeded.get('statements', 0)
+    for thread in threads:
+        thread.join()
+
+    rows = execute_query("""
+        SELECT request_id::text, status,
+               EXTRACT(EPOCH FROM created_at)::float8, EXTRACT(EPOCH FROM completed_at)::float8
+        FROM image_requests WHERE user_id = %s
+    """, (SIM_USER_ID,))
+    finished = [row for row in rows if row[1] in FINISHED_STATUSES]
+    waits = [backend.started[row[0]] - row[2] for row in rows if row[0] in backend.started]
+    turnarounds = [row[3] - row[2] for row in finished if row[3] is not None]
+
+    def rounded(value, digits=2):
+        return round(value, digits) if value is not None else None
+
+    return {
+        'worker': worker,
+        'workers': args.workers,
+        'concurrency': concurrency,
+        'batch_size': batch_size,
+        'poll_interval': poll_interval,
+        'jobs': len(rows),
+        'finished': len(finished),
+        'failed': sum(1 for row in rows if row[1] == job_states.FAILED),
+        'unfinished': len(rows) - len(finished),
+        'drained': drained_at is not None,
+        'elapsed_s': rounded(elapsed),
+        'throughput_per_s': rounded(len(finished) / elapsed if elapsed else 0, 3),
+        'wait_p50_s': rounded(percentile(waits, 0.5)),
+        'wait_p95_s': rounded(percentile(waits, 0.95)),
+        'wait_max_s': rounded(max(waits) if waits else None),
+        'turnaround_p50_s': rounded(percentile(turnarounds, 0.5)),
+        'turnaround_p95_s': rounded(percentile(turnarounds, 0.95)),
+        'db_queries_per_s': rounded(worker_queries / elapsed if elapsed else 0),
+        'db_queries_per_job': rounded(worker_queries / len(finished) if finished else None),
+        'backend_calls': backend.calls,
+        'backend_failures': backend.failures,
+    }
+
+
+def print_table(results):
+    columns = ['concurrency', 'batch_size', 'poll_interval', 'finished', 'unfinished', 'elapsed_s',
+               'throughput_per_s', 'wait_p50_s', 'wait_p95_s', 'turnaround_p95_s',
+               'db_queries_per_s', 'db_queries_per_job']
+    if not results:
+        print("No runs completed, nothing to report")
+        return
+    widths = [max(len(c), *(len(str(r[c])) for r in results)) for c in columns]
+    print('  '.join(c.rjust(w) for c, w in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[c]).rjust(w) for c, w in zip(columns, widths)))
+    best = max(results, key=lambda r: (r['drained'], r['throughput_per_s'], -(r['db_queries_per_s'] or 0)))
+    print(f"\nHighest throughput: concurrency={best['concurrency']} batch_size={best['batch_size']} "
+          f"poll_interval={best['poll_interval']} ({best['throughput_per_s']} jobs/s, "
+          f"p95 wait {best['wait_p95_s']}s, {best['db_queries_per_s']} queries/s)")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Simulate worker throughput against a local Postgres")
+    parser.add_argument('--worker', choices=sorted(WORKERS), default='process_images')
+    parser.add_argument('--workers', type=int, default=1, help="worker loops to run side by side")
+    parser.add_argument('--concurrency', type=parse_list(int), default=[1])
+    parser.add_argument('--batch-size', type=parse_list(int), default=[10])
+    parser.add_argument('--poll-interval', type=parse_list(float), default=[10.0])
+    parser.add_argument('--error-sleep', type=float, default=30.0)
+    parser.add_argument('--jobs', type=int, default=120, help="jobs queued per run")
+    parser.add_argument('--arrival-rate', type=float, default=0.0,
+                        help="jobs per second queued during the run; 0 queues them all up front")
+    parser.add_argument('--themes-per-request', type=int, default=12)
+    parser.add_argument('--latency', type=parse_distribution, default='lognormal:8,0.4',
+                        help="generation latency distribution")
+    parser.add_argument('--vision-latency', type=parse_distribution, default='lognormal:3,0.3',
+                        help="vision description latency distribution")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of backend calls that fail")
+    parser.add_argument('--result-bytes', type=int, default=1_500_000, help="size of each generated image")
+    parser.add_argument('--timeout', type=float, default=600.0, help="seconds before a run is cut off")
+    parser.add_argument('--monitor-interval', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--csv', help="also write the results to this file")
+    parser.add_argument('--verbose', action='store_true', help="keep the workers' INFO logging")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run the parameter sweep and print a summary table."""
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if not args.verbose:
+        for name in ('process_images', 'background', 'helper', 'db', 'theme_catalog', 'profiling'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+    largest = args.workers * max(max(args.concurrency), 1)
+    if largest + 2 > DB_POOL_MAX:
+        logger.warning(f"Up to {largest} jobs run at once but DB_POOL_MAX is {DB_POOL_MAX}; pool waits will count against throughput")
+
+    backend = FakeBackend(args.latency, args.vision_latency, args.failure_rate, args.result_bytes, args.seed)
+    backend.install()
+
+    execute_query(
+        "INSERT INTO users (user_id, credits, subscription_type) VALUES (%s, 0, 'simulation') ON CONFLICT DO NOTHING",
+        (SIM_USER_ID,)
+    )
+    check_database_is_idle()
+
+    results = []
+    try:
+        for concurrency, batch_size, poll_interval in itertools.product(
+                args.concurrency, args.batch_size, args.poll_interval):
+            logger.warning(f"Simulating concurrency={concurrency} batch_size={batch_size} poll_interval={poll_interval}")
+            result = run_once(args.worker, backend, args, concurrency, batch_size, poll_interval)
+            results.append(result)
+            if not result['drained']:
+                logger.warning(f"Run hit the {args.timeout}s timeout with {result['unfinished']} jobs unfinished")
+    finally:
+        cleanup()
+        execute_query("DELETE FROM users WHERE user_id = %s", (SIM_USER_ID,))
+
+    print_table(results)
+    if args.csv and results:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+import admission
+from admission import QueueStats
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(admission, 'ADMISSION_MAX_BACKLOG', 600)
+    monkeypatch.setattr(admission, 'ADMISSION_MAX_WAIT', 300)
+    monkeypatch.setattr(admission, 'ADMISSION_STATS_TTL', 60)
+    monkeypatch.setattr(admission, '_cached', None)
+
+
+def _queue(monkeypatch, depth, in_progress, throughput):
+    stats = QueueStats(depth, in_progress, throughput, True, 0, {})
+    monkeypatch.setattr(admission, '_cached', stats)
+    monkeypatch.setattr(admission, '_cached_at', time.monotonic())
+
+
+def test_admits_within_headroom(monkeypatch):
+    _queue(monkeypatch, depth=50, in_progress=10, throughput=1.0)
+    decision = admission.check(12)
+    assert decision.admitted
+    assert decision.headroom == 240
+    assert decision.estimated_wait == pytest.approx(72)
+    assert decision.retry_after == 0
+
+
+def test_rejects_past_max_wait(monkeypatch):
+    _queue(monkeypatch, depth=290, in_progress=10, throughput=1.0)
+    decision = admission.check(12)
+    assert not decision.admitted
+    assert decision.headroom == 0
+    assert decision.retry_after == 12
+
+
+def test_rejects_past_max_backlog(monkeypatch):
+    _queue(monkeypatch, depth=595, in_progress=5, throughput=100.0)
+    decision = admission.check(12)
+    assert not decision.admitted
+    assert decision.headroom == 5
+    assert decision.retry_after == 1
+
+
+def test_idle_queue_always_admits(monkeypatch):
+    _queue(monkeypatch, depth=0, in_progress=0, throughput=0.5)
+    decision = admission.check(500)
+    assert decision.admitted
+    assert decision.headroom == 150
+
+
+def test_admitted_jobs_count_until_the_next_measurement(monkeypatch):
+    _queue(monkeypatch, depth=280, in_progress=0, throughput=1.0)
+    assert admission.check(12).admitted
+    admission.record_admitted(12)
+    assert not admission.check(12).admitted
+    admission.record_cancelled(12)
+    assert admission.check(12).admitted
@@ -0,0 +1,53 @@
+import io
+import zipfile
+
+import bundle
+
+
+def _results():
+    return [
+        ('11111111-1111-1111-1111-111111111111', 3, 'image/jpeg', b'\xff\xd8' + bytes(range(256)) * 600),
+        ('22222222-2222-2222-2222-222222222222', 7, 'image/png', b'\x89PNG small'),
+        ('33333333-3333-3333-3333-333333333333', 9, 'image/jpeg', b''),
+    ]
+
+
+def test_stream_zip_produces_a_valid_stored_archive():
+    results = _results()
+    body = b''.join(bundle.stream_zip(iter(results)))
+
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        assert archive.testzip() is None
+        infos = archive.infolist()
+        assert [info.filename for info in infos] == [
+            '11111111-1111-1111-1111-111111111111.jpg',
+            '22222222-2222-2222-2222-222222222222.png',
+            '33333333-3333-3333-3333-333333333333.jpg',
+        ]
+        for info, (_, theme_id, _, data) in zip(infos, results):
+            assert info.compress_type == zipfile.ZIP_STORED
+            assert info.comment == str(theme_id).encode()
+            assert archive.read(info) == data
+
+
+def test_stream_zip_yields_large_entries_in_chunks():
+    data = b'x' * (bundle.CHUNK_SIZE * 3 + 5)
+    chunks = list(bundle.stream_zip([('id', 1, 'image/jpeg', data)]))
+    assert len(chunks) > 3
+    assert max(len(chunk) for chunk in chunks) < 2 * bundle.CHUNK_SIZE
+
+
+def test_stream_zip_without_results_is_an_empty_archive():
+    body = b''.join(bundle.stream_zip([]))
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        assert archive.namelist() == []
+
+
+def test_stream_multipart_frames_every_part():
+    body = b''.join(bundle.stream_multipart(_results()[:2], 'BOUNDARY'))
+    parts = body.split(b'--BOUNDARY')
+    assert parts[0] == b'' and parts[-1] == b'--\r\n'
+    headers, payload = parts[2].split(b'\r\n\r\n', 1)
+    assert b'Content-Type: image/png' in headers
+    assert b'X-Theme-Id: 7' in headers
+    assert payload == b'\x89PNG small\r\n'
@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+from image_cache import CachedImage, ImageCache, SingleFlight
+
+
+def _image(size):
+    return CachedImage('user', 'ready', 'full', b'x' * size, 'image/jpeg')
+
+
+def test_evicts_least_recently_used_to_stay_in_budget():
+    cache = ImageCache(max_bytes=100, max_item_bytes=100, ttl=60)
+    cache.put('a', _image(40))
+    cache.put('b', _image(40))
+    assert cache.get('a') is not None
+    cache.put('c', _image(40))
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+    stats = cache.stats()
+    assert stats['bytes'] == 80
+    assert stats['entries'] == 2
+    assert stats['evictions'] == 1
+
+
+def test_replacing_an_entry_does_not_double_count_it():
+    cache = ImageCache(max_bytes=100, max_item_bytes=100, ttl=60)
+    cache.put('a', _image(40))
+    cache.put('a', _image(60))
+    assert cache.stats()['bytes'] == 60
+    assert len(cache.get('a').data) == 60
+
+
+def test_skips_images_over_the_item_limit():
+    cache = ImageCache(max_bytes=100, max_item_bytes=30, ttl=60)
+    cache.put('a', _image(20))
+    cache.put('big', _image(31))
+    assert cache.get('big') is None
+    assert cache.get('a') is not None
+
+
+def test_expired_entries_are_dropped():
+    cache = ImageCache(max_bytes=100, max_item_bytes=100, ttl=0)
+    cache.put('a', _image(10))
+    assert cache.get('a') is None
+    stats = cache.stats()
+    assert stats['expirations'] == 1
+    assert stats['bytes'] == 0
+
+
+def test_single_flight_shares_one_call_between_concurrent_callers():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'image'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do('key', load)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do('key', load))) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    while flight.coalesced < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert calls == [1]
+    assert results == ['image'] * 4
+
+
+def test_single_flight_raises_the_error_and_forgets_the_key():
+    flight = SingleFlight()
+
+    def fail():
+        raise LookupError('gone')
+
+    with pytest.raises(LookupError):
+        flight.do('key', fail)
+    assert flight.do('key', lambda: 'retried') == 'retried'
@@ -0,0 +1,52 @@
+import numpy as np
+
+from image_hash import Match, PerceptualHashIndex, hamming_distances
+
+
+def test_hamming_distances():
+    hashes = np.array([0, 0b1011, 2**64 - 1], dtype=np.uint64)
+    assert list(hamming_distances(hashes, 0)) == [0, 3, 64]
+
+
+def test_find_returns_nearest_within_max_distance():
+    index = PerceptualHashIndex(max_distance=4, max_entries=10)
+    index.add(0b1111, 'beach', 'far', 'u1')
+    index.add(0b0001, 'beach', 'near', 'u2')
+    assert index.find(0b0000, 'beach') == Match('near', 'u2', 1)
+    assert index.find(0xFF00, 'beach') is None
+
+
+def test_lookups_only_compare_within_the_same_description():
+    index = PerceptualHashIndex(max_distance=4, max_entries=10)
+    index.add(0b1, 'beach', 'img', 'u1')
+    assert index.find(0b1, 'forest') is None
+    assert index.find(0b1, 'beach').image_id == 'img'
+
+
+def test_missing_description_shares_one_bucket():
+    index = PerceptualHashIndex(max_distance=0, max_entries=10)
+    index.add(7, None, 'img')
+    assert index.find(7, '') == Match('img', None, 0)
+
+
+def test_oldest_entries_are_evicted_past_max_entries():
+    index = PerceptualHashIndex(max_distance=0, max_entries=2)
+    index.add(1, 'a', 'first')
+    index.add(2, 'b', 'second')
+    index.add(3, 'b', 'third')
+    assert len(index) == 2
+    assert index.find(1, 'a') is None
+    assert index.find(2, 'b').image_id == 'second'
+    assert index.find(3, 'b').image_id == 'third'
+
+
+def test_eviction_starts_from_least_recently_added_bucket():
+    index = PerceptualHashIndex(max_distance=0, max_entries=2)
+    index.add(1, 'a', 'a1')
+    index.add(2, 'b', 'b1')
+    index.add(3, 'a', 'a2')
+    index.add(4, 'c', 'c1')
+    assert index.find(2, 'b') is None
+    assert index.find(1, 'a') is None
+    assert index.find(3, 'a').image_id == 'a2'
+    assert index.find(4, 'c').image_id == 'c1'
@@ -0,0 +1,46 @@
+import logging
+
+import log_config
+from log_config import SamplingFilter, parse_sample_rates
+
+
+def _record(name, level=logging.INFO):
+    return logging.LogRecord(name, level, __file__, 1, "message", None, None)
+
+
+def test_parse_sample_rates_clamps_and_skips_invalid_entries():
+    rates = parse_sample_rates(" helper = 0.25 ,db=2,image_cache=-1,bogus,theme=abc,")
+    assert rates == {'helper': 0.25, 'db': 1.0, 'image_cache': 0.0}
+
+
+def test_parse_sample_rates_empty():
+    assert parse_sample_rates(None) == {}
+    assert parse_sample_rates('') == {}
+
+
+def test_longest_prefix_wins():
+    sampling = SamplingFilter({'helper': 0.0, 'helper.openai': 1.0})
+    assert sampling.filter(_record('helper.openai'))
+    assert sampling.filter(_record('helper.openai.retry'))
+    assert not sampling.filter(_record('helper'))
+    assert not sampling.filter(_record('helper.images'))
+
+
+def test_prefix_matches_whole_logger_name_segments():
+    sampling = SamplingFilter({'helper': 0.0})
+    assert sampling.filter(_record('helpers'))
+    assert sampling.filter(_record('main'))
+
+
+def test_warnings_are_never_sampled():
+    sampling = SamplingFilter({'helper': 0.0})
+    assert sampling.filter(_record('helper', logging.WARNING))
+    assert sampling.filter(_record('helper', logging.ERROR))
+
+
+def test_partial_rate_uses_random(monkeypatch):
+    sampling = SamplingFilter({'background': 0.1})
+    monkeypatch.setattr(log_config.random, 'random', lambda: 0.05)
+    assert sampling.filter(_record('background'))
+    monkeypatch.setattr(log_config.random, 'random', lambda: 0.5)
+    assert not sampling.filter(_record('background'))
@@ -0,0 +1,35 @@
+import numpy as np
+
+from theme_ranking import pick_top, score_themes
+
+
+def test_pick_top_without_temperature_is_sorted_best_first():
+    assert pick_top([0.1, 3.0, -1.0, 2.0], 3, temperature=0) == [1, 3, 0]
+
+
+def test_pick_top_caps_num_at_the_number_of_themes():
+    assert sorted(pick_top([1.0, 2.0], 5, temperature=0)) == [0, 1]
+    assert pick_top([1.0, 2.0], 0) == []
+    assert pick_top([], 3) == []
+
+
+def test_pick_top_draws_distinct_indices():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        picked = pick_top(np.zeros(20), 12, temperature=1.0, rng=rng)
+        assert len(picked) == 12
+        assert len(set(picked)) == 12
+
+
+def test_pick_top_favours_high_scores():
+    rng = np.random.default_rng(1)
+    scores = [5.0, 0.0, 0.0, 0.0]
+    firsts = [pick_top(scores, 1, temperature=0.5, rng=rng)[0] for _ in range(200)]
+    assert firsts.count(0) > 190
+
+
+def test_score_themes_prefers_downloaded_and_unseen_themes():
+    scores = score_themes(seen=[10, 10, 0], downloads=[8, 0, 0],
+                          global_seen=[100, 100, 100], global_downloads=[50, 50, 50],
+                          prior_weight=5, novelty=0.3)
+    assert scores[0] > scores[2] > scores[1]
@@ -0,0 +1,182 @@
+"""
+Process-local cache of the themes table.
+
+The catalog is loaded once and then served from memory. It is refreshed when
+it is older than THEME_CACHE_TTL seconds, or as soon as Postgres sends a
+NOTIFY on the 'themes_changed' channel (see the trigger in postgres/init.sql).
+Readers always see a complete snapshot; a refresh builds a new one and swaps
+it in, so lookups never wait on the database once the first load is done.
+"""
+
+import logging
+import os
+import random
+import select
+import threading
+import time
+
+from db import execute_query, open_dedicated_connection
+
+logger = logging.getLogger(__name__)
+
+THEME_CACHE_TTL = float(os.getenv('THEME_CACHE_TTL', '300'))
+THEME_CACHE_LISTEN = os.getenv('THEME_CACHE_LISTEN', '1').lower() in ('1', 'true', 'yes')
+THEMES_CHANGED_CHANNEL = 'themes_changed'
+MISS_RELOAD_INTERVAL = 5
+
+
+class _Snapshot:
+    """Immutable view of the themes table at one point in time."""
+
+    __slots__ = ('ids', 'by_id', 'loaded_at')
+
+    def __init__(self, rows):
+        self.by_id = {str(theme_id): theme for theme_id, theme in rows}
+        self.ids = tuple(self.by_id)
+        self.loaded_at = time.monotonic()
+
+
+class ThemeCatalog:
+    """
+    In-memory catalog of themes keyed by id.
+
+    Args:
+        ttl: Seconds after which the snapshot is reloaded on next access
+        listen: Start a LISTEN thread that invalidates the snapshot on NOTIFY
+    """
+
+    def __init__(self, ttl=THEME_CACHE_TTL, listen=THEME_CACHE_LISTEN):
+        self.ttl = ttl
+        self._snapshot = None
+        self._stale = True
+        self._refresh_lock = threading.Lock()
+        self._listener = None
+        if listen:
+            self._start_listener()
+
+    def _load(self):
+        rows = execute_query("SELECT id, theme FROM themes")
+        snapshot = _Snapshot(rows or [])
+        self._snapshot = snapshot
+        self._stale = False
+        logger.info(f"Loaded {len(snapshot.ids)} themes into catalog")
+        return snapshot
+
+    def refresh(self):
+        """Reload the catalog from the database."""
+        with self._refresh_lock:
+            return self._load()
+
+    def invalidate(self):
+        """Mark the catalog stale so the next access reloads it."""
+        self._stale = True
+
+    def _current(self):
+        snapshot = self._snapshot
+        if snapshot is not None and not self._stale and time.monotonic() - snapshot.loaded_at < self.ttl:
+            return snapshot
+
+        if snapshot is None:
+            # Nothing to serve yet, every caller has to wait for the first load.
+            with self._refresh_lock:
+                if self._snapshot is None or self._stale:
+                    return self._load()
+                return self._snapshot
+
+        # One caller reloads, everyone else keeps using the old snapshot.
+        if self._refresh_lock.acquire(blocking=False):
+            try:
+                return self._load()
+            except Exception as e:
+                logger.error(f"Error refreshing theme catalog, serving stale copy: {str(e)}")
+                return snapshot
+            finally:
+                self._refresh_lock.release()
+        return snapshot
+
+    def sample(self, num):
+        """
+        Pick up to num distinct theme ids at random.
+
+        Args:
+            num: Number of theme ids to return
+
+        Returns:
+            list: Theme ids as strings
+        """
+        ids = self._current().ids
+        return random.sample(ids, min(num, len(ids)))
+
+    def ids(self):
+        """All theme ids of the current snapshot, as a tuple of strings."""
+        return self._current().ids
+
+    def get(self, theme_id):
+        """
+        Get the theme prompt for a theme id.
+
+        An unknown id forces a reload (at most once per MISS_RELOAD_INTERVAL)
+        in case the theme was added after the last refresh.
+
+        Returns:
+            str or None: The theme text, or None if the id does not exist
+        """
+        key = str(theme_id)
+        snapshot = self._current()
+        theme = snapshot.by_id.get(key)
+        if theme is None and time.monotonic() - snapshot.loaded_at > MISS_RELOAD_INTERVAL:
+            with self._refresh_lock:
+                theme = self._load().by_id.get(key)
+        return theme
+
+    def __len__(self):
+        return len(self._current().ids)
+
+    def _start_listener(self):
+        self._listener = threading.Thread(target=self._listen_loop, name='theme-catalog-listener', daemon=True)
+        self._listener.start()
+
+    def _listen_loop(self):
+        reconnecting = False
+        while True:
+            conn = None
+            try:
+                conn = open_dedicated_connection()
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {THEMES_CHANGED_CHANNEL}")
+                if reconnecting:
+                    # Anything could have changed while we were not listening.
+                    self.invalidate()
+                reconnecting = True
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        logger.info("Themes changed, invalidating catalog")
+                        self.invalidate()
+            except Exception as e:
+                logger.warning(f"Theme catalog listener stopped, retrying in 30s: {str(e)}")
+                time.sleep(30)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """Get the process-wide ThemeCatalog, creating it on first use."""
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = ThemeCatalog()
+    return _catalog
@@ -0,0 +1,244 @@
+"""
+Per-user theme ranking for /api/create.
+
+Postgres keeps user_theme_stats(user_id, theme_id, seen, downloads) up to
+date with triggers (see postgres/init.sql):
+- seen goes up for every image_requests row inserted
+- downloads goes up for every 'download_image' action written
+Nothing is aggregated on the request path.
+
+Ranking a user's themes needs one primary-key range read of that user's
+stats row set (one row per theme they have been shown). The read is cached
+per process for THEME_RANKING_CACHE_TTL seconds and bumped locally when this
+process queues new themes. The read runs on a small thread pool, and callers
+wait at most THEME_RANKING_TIMEOUT_MS for it. Past that they fall back to
+stale stats, or to a random pick when the user has none cached, so a slow
+database cannot hold up uploads.
+
+Each theme's score is computed for all themes at once with numpy:
+- the user's smoothed download rate, with the theme's download rate across
+  all users as the prior
+- a bonus for themes the user has never been shown
+The num themes are then drawn with Gumbel noise scaled by
+THEME_RANKING_TEMPERATURE, so favourites come up more often without every
+request getting the same set.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from db import execute_query
+from theme_catalog import get_catalog
+
+logger = logging.getLogger(__name__)
+
+THEME_RANKING_ENABLED = os.getenv('THEME_RANKING_ENABLED', '1').lower() in ('1', 'true', 'yes')
+THEME_RANKING_TIMEOUT_MS = float(os.getenv('THEME_RANKING_TIMEOUT_MS', '50'))
+THEME_RANKING_CACHE_TTL = float(os.getenv('THEME_RANKING_CACHE_TTL', '60'))
+THEME_RANKING_GLOBAL_TTL = float(os.getenv('THEME_RANKING_GLOBAL_TTL', '300'))
+THEME_RANKING_MAX_USERS = int(os.getenv('THEME_RANKING_MAX_USERS', '10000'))
+# How many showings the global download rate counts for in a user's rate.
+THEME_RANKING_PRIOR_WEIGHT = float(os.getenv('THEME_RANKING_PRIOR_WEIGHT', '5'))
+# Added to the log score of themes the user has never been shown.
+THEME_RANKING_NOVELTY = float(os.getenv('THEME_RANKING_NOVELTY', '0.3'))
+# 0 always picks the top themes; higher values pick more at random.
+THEME_RANKING_TEMPERATURE = float(os.getenv('THEME_RANKING_TEMPERATURE', '0.5'))
+
+
+def score_themes(seen, downloads, global_seen, global_downloads,
+                 prior_weight=THEME_RANKING_PRIOR_WEIGHT, novelty=THEME_RANKING_NOVELTY):
+    """
+    Score every theme for one user.
+
+    Args:
+        seen, downloads: Arrays with the user's counts, one entry per theme
+        global_seen, global_downloads: Arrays with every user's counts
+        prior_weight: Weight of the global rate in the user's rate
+        novelty: Bonus for themes the user has not been shown
+
+    Returns:
+        numpy.ndarray: Log scores, higher is better
+    """
+    import numpy as np
+
+    seen = np.asarray(seen, dtype=np.float64)
+    downloads = np.asarray(downloads, dtype=np.float64)
+    # Laplace-smoothed so themes nobody has seen yet start at 1/2
+    prior = (np.asarray(global_downloads, dtype=np.float64) + 1) / (np.asarray(global_seen, dtype=np.float64) + 2)
+    rate = (downloads + prior_weight * prior) / (seen + prior_weight)
+    return np.log(np.clip(rate, 1e-6, None)) + novelty * (seen == 0)
+
+
+def pick_top(scores, num, temperature=THEME_RANKING_TEMPERATURE, rng=None):
+    """
+    Draw num distinct indices, favouring high scores.
+
+    Adding Gumbel noise and taking the top num samples without replacement
+    from softmax(scores / temperature).
+
+    Returns:
+        list: Indices into scores, best first
+    """
+    import numpy as np
+
+    scores = np.asarray(scores, dtype=np.float64)
+    num = min(num, len(scores))
+    if num <= 0:
+        return []
+    if temperature > 0:
+        rng = rng or np.random.default_rng()
+        scores = scores + temperature * rng.gumbel(size=len(scores))
+    top = np.argpartition(-scores, num - 1)[:num]
+    return [int(i) for i in top[np.argsort(-scores[top])]]
+
+
+class ThemeRanker:
+    """
+    Cached per-user stats plus bounded-latency ranking.
+
+    Args:
+        timeout_ms: Longest a caller waits for a stats read
+        cache_ttl: Seconds a user's stats are served without a read
+        max_users: Users whose stats are kept in memory
+    """
+
+    def __init__(self, timeout_ms=THEME_RANKING_TIMEOUT_MS, cache_ttl=THEME_RANKING_CACHE_TTL,
+                 max_users=THEME_RANKING_MAX_USERS):
+        self.timeout = timeout_ms / 1000
+        self.cache_ttl = cache_ttl
+        self.max_users = max_users
+        self._users = OrderedDict()
+        self._global = ({}, None)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(4, thread_name_prefix='theme-ranking')
+        self.fallbacks = 0
+
+    def _fetch_user(self, user_id):
+        rows = execute_query(
+            "SELECT theme_id, seen, downloads FROM user_theme_stats WHERE user_id = %s",
+            (user_id,)
+        )
+        stats = {theme_id: [seen, downloads] for theme_id, seen, downloads in rows or []}
+        with self._lock:
+            self._users[user_id] = (stats, time.monotonic())
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return stats
+
+    def _fetch_global(self):
+        rows = execute_query(
+            "SELECT theme_id, SUM(seen), SUM(downloads) FROM user_theme_stats GROUP BY theme_id"
+        )
+        stats = {theme_id: (int(seen), int(downloads)) for theme_id, seen, downloads in rows or []}
+        self._global = (stats, time.monotonic())
+        return stats
+
+    def _submit_once(self, key, fn, *args):
+        # One read per key in flight, however many callers are waiting on it
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = self._executor.submit(fn, *args)
+                future.add_done_callback(lambda f: self._pending.pop(key, None))
+        return future
+
+    def _wait(self, future, fallback):
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            return fallback
+        except Exception as e:
+            logger.error(f"Error reading theme stats: {str(e)}")
+            return fallback
+
+    def user_stats(self, user_id):
+        """
+        Get a user's {theme_id: [seen, downloads]}, waiting at most timeout_ms.
+
+        Returns:
+            dict or None: Possibly stale stats, None if none could be read in time
+        """
+        with self._lock:
+            cached = self._users.get(user_id)
+        if cached is not None and time.monotonic() - cached[1] < self.cache_ttl:
+            return cached[0]
+        future = self._submit_once(('user', user_id), self._fetch_user, user_id)
+        return self._wait(future, cached[0] if cached is not None else None)
+
+    def global_stats(self):
+        """Every user's counts per theme; refreshed in the background once stale."""
+        stats, loaded_at = self._global
+        if loaded_at is not None and time.monotonic() - loaded_at < THEME_RANKING_GLOBAL_TTL:
+            return stats
+        future = self._submit_once(('global',), self._fetch_global)
+        # Stale global rates are fine; only the very first load is waited for
+        return stats if loaded_at is not None else self._wait(future, stats)
+
+    def rank(self, user_id, num):
+        """
+        Choose num themes for a user.
+
+        Returns:
+            list: Theme ids, or a random sample if the user's stats could not
+            be read within timeout_ms
+        """
+        catalog = get_catalog()
+        theme_ids = catalog.ids()
+        stats = self.user_stats(str(user_id))
+        if stats is None:
+            self.fallbacks += 1
+            logger.warning(f"Theme stats for user {user_id} not available in time, picking at random")
+            return catalog.sample(num)
+
+        global_stats = self.global_stats()
+        empty = (0, 0)
+        user_rows = [stats.get(theme_id, empty) for theme_id in theme_ids]
+        global_rows = [global_stats.get(theme_id, empty) for theme_id in theme_ids]
+        scores = score_themes(
+            [row[0] for row in user_rows], [row[1] for row in user_rows],
+            [row[0] for row in global_rows], [row[1] for row in global_rows]
+        )
+        return [theme_ids[i] for i in pick_top(scores, num)]
+
+    def record_seen(self, user_id, theme_ids):
+        """Count freshly queued themes into the cached stats until the next read."""
+        with self._lock:
+            cached = self._users.get(str(user_id))
+            if cached is None:
+                return
+            for theme_id in theme_ids:
+                cached[0].setdefault(theme_id, [0, 0])[0] += 1
+
+
+_ranker = None
+_ranker_lock = threading.Lock()
+
+
+def get_ranker():
+    """Get the process-wide ThemeRanker, creating it on first use."""
+    global _ranker
+    if _ranker is None:
+        with _ranker_lock:
+            if _ranker is None:
+                _ranker = ThemeRanker()
+    return _ranker
+
+
+def rank_themes(user_id, num):
+    """
+    Choose num distinct themes for a user, favouring themes they download.
+
+    Falls back to a random pick when ranking is disabled (THEME_RANKING_ENABLED).
+
+    Returns:
+        list: Theme ids as strings
+    """
+    if not THEME_RANKING_ENABLED or not user_id:
+        return get_catalog().sample(num)
+    return get_ranker().rank(user_id, num)
@@ -0,0 +1,93 @@
+"""
+Startup warm-up and readiness for web processes.
+
+start() runs the warm-up on a background thread so the app can bind its port
+straight away:
+
+1. Open DB_POOL_PREWARM connections per pool and load the theme catalog.
+   Only then does is_ready() turn true, so /api/ready keeps new containers
+   out of the load balancer until the first burst won't pay for connection
+   setup. Failures are retried every STARTUP_RETRY_INTERVAL seconds.
+2. With STARTUP_PRELOAD set (default), import the modules that the web tier
+   loads lazily (PIL, numpy, openai, requests) and warm the near-duplicate
+   index. This runs after readiness, so it speeds up the first uploads
+   without delaying the first requests.
+"""
+
+import importlib
+import logging
+import os
+import threading
+import time
+
+from db import prewarm_pools, DB_POOL_PREWARM
+
+logger = logging.getLogger(__name__)
+
+STARTUP_PRELOAD = os.getenv('STARTUP_PRELOAD', '1').lower() in ('1', 'true', 'yes')
+STARTUP_RETRY_INTERVAL = float(os.getenv('STARTUP_RETRY_INTERVAL', '2'))
+
+PRELOAD_MODULES = ('PIL.Image', 'numpy', 'requests', 'openai')
+
+_ready = threading.Event()
+_started_at = time.monotonic()
+_state = {'ready_ms': None, 'preloaded_ms': None, 'connections_opened': 0, 'attempts': 0, 'last_error': None}
+_thread = None
+_thread_lock = threading.Lock()
+
+
+def _timed_ms():
+    return round((time.monotonic() - _started_at) * 1000, 1)
+
+
+def _warm_up():
+    from theme_catalog import get_catalog
+
+    while True:
+        _state['attempts'] += 1
+        try:
+            _state['connections_opened'] += prewarm_pools(DB_POOL_PREWARM)
+            # get_catalog() alone only builds the catalog; ids() loads the themes
+            get_catalog().ids()
+            break
+        except Exception as e:
+            _state['last_error'] = str(e)
+            logger.error(f"Startup warm-up failed, retrying in {STARTUP_RETRY_INTERVAL}s: {str(e)}")
+            time.sleep(STARTUP_RETRY_INTERVAL)
+
+    _state['ready_ms'] = _timed_ms()
+    _ready.set()
+    logger.info(f"Ready {_state['ready_ms']} ms after startup")
+
+    if not STARTUP_PRELOAD:
+        return
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            logger.warning(f"Could not preload {name}: {str(e)}")
+    try:
+        from image_hash import get_index
+        get_index()
+    except Exception as e:
+        logger.warning(f"Could not warm the near-duplicate index: {str(e)}")
+    _state['preloaded_ms'] = _timed_ms()
+
+
+def start():
+    """Start the warm-up thread; later calls do nothing."""
+    global _thread
+    with _thread_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_warm_up, name='startup-warmup', daemon=True)
+            _thread.start()
+
+
+def is_ready():
+    """Whether pools and catalog are warm."""
+    return _ready.is_set()
+
+
+def status():
+    """Readiness plus startup timings, in ms since this module was imported."""
+    return dict(_state, ready=is_ready(), uptime_ms=_timed_ms())
@@ -29,14 +29,196 @@ CREATE TABLE themes (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Partitioned by month on created_at. retention.py creates upcoming monthly
+-- partitions and drops expired ones; rows outside any monthly partition land
+-- in image_requests_default.
 CREATE TABLE image_requests (
-    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
     request_id UUID NOT NULL,
     source_image_id UUID NOT NULL REFERENCES images(id),
     theme_id TEXT NOT NULL,
     result_image_id UUID NOT NULL,
     user_id UUID NOT NULL REFERENCES users(user_id),
     user_description TEXT,
+    -- One of job_states.STATES; see job_states.py for the transitions
+    status TEXT NOT NULL CHECK (status IN ('new', 'retry', 'processing', 'ready', 'failed', 'cancelled', 'expired')),
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    completed_at TIMESTAMP WITH TIME ZONE,
+    -- Tier the next generation pass produces, and the tier stored so far (see quality.py)
+    quality_tier TEXT NOT NULL DEFAULT 'full',
+    stored_tier TEXT,
+    -- Workers claim lower values first; full-resolution upgrades of previews wait behind new jobs
+    priority SMALLINT NOT NULL DEFAULT 0,
+    -- Times a worker has claimed the result; failures are retried up to JOB_MAX_ATTEMPTS
+    attempts SMALLINT NOT NULL DEFAULT 0,
+    -- Worker that takes the job: 'generate' (process_images.py) or 'test' (background.py)
+    queue TEXT NOT NULL DEFAULT 'generate',
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE image_requests_default PARTITION OF image_requests DEFAULT;
+
+-- This month and the next two (RETENTION_PARTITIONS_AHEAD); retention.py adds later ones.
+DO $$
+DECLARE
+    month_start DATE;
+BEGIN
+    FOR month_start IN
+        SELECT generate_series(
+            date_trunc('month', NOW()),
+            date_trunc('month', NOW()) + INTERVAL '2 months',
+            INTERVAL '1 month'
+        )::date
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF image_requests FOR VALUES FROM (%L) TO (%L)',
+            'image_requests_' || to_char(month_start, 'YYYY_MM'),
+            month_start,
+            (month_start + INTERVAL '1 month')::date
+        );
+    END LOOP;
+END $$;
+
+CREATE INDEX image_requests_result_image_id_idx ON image_requests (result_image_id);
+CREATE INDEX image_requests_queue_status_priority_idx ON image_requests (queue, status, priority, created_at);
+CREATE INDEX image_requests_source_image_id_idx ON image_requests (source_image_id);
+-- Recent completions, for measuring worker throughput.
+CREATE INDEX image_requests_completed_at_idx ON image_requests (completed_at) WHERE completed_at IS NOT NULL;
+
+-- Lets the retention job tell downloaded results apart from abandoned ones.
+CREATE INDEX actions_download_result_image_id_idx ON actions ((metadata->>'result_image_id'))
+    WHERE action = 'download_image';
+CREATE INDEX images_created_at_idx ON images (created_at);
+
+-- Tell running processes to reload their in-memory theme catalog.
+CREATE OR REPLACE FUNCTION notify_themes_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('themes_changed', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER themes_changed
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON themes
+FOR EACH STATEMENT EXECUTE FUNCTION notify_themes_changed();
+
+-- Idempotency keys for /api/create: a retried request_id gets the stored response.
+CREATE TABLE create_requests (
+    request_id UUID PRIMARY KEY,
+    user_id UUID NOT NULL,
+    response JSONB,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Per-user theme counts for theme_ranking.py, kept current by the triggers below.
+CREATE TABLE user_theme_stats (
+    user_id UUID NOT NULL,
+    theme_id TEXT NOT NULL,
+    seen INTEGER NOT NULL DEFAULT 0,
+    downloads INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, theme_id)
+);
+
+CREATE OR REPLACE FUNCTION count_theme_seen() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO user_theme_stats (user_id, theme_id, seen)
+    VALUES (NEW.user_id, NEW.theme_id, 1)
+    ON CONFLICT (user_id, theme_id) DO UPDATE
+    SET seen = user_theme_stats.seen + 1, updated_at = CURRENT_TIMESTAMP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER image_requests_count_theme_seen
+AFTER INSERT ON image_requests
+FOR EACH ROW EXECUTE FUNCTION count_theme_seen();
+
+CREATE OR REPLACE FUNCTION count_theme_download() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO user_theme_stats (user_id, theme_id, downloads)
+    SELECT ir.user_id, ir.theme_id, 1
+    FROM image_requests ir
+    WHERE ir.result_image_id = (NEW.metadata->>'result_image_id')::uuid
+    LIMIT 1
+    ON CONFLICT (user_id, theme_id) DO UPDATE
+    SET downloads = user_theme_stats.downloads + 1, updated_at = CURRENT_TIMESTAMP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER actions_count_theme_download
+AFTER INSERT ON actions
+FOR EACH ROW WHEN (NEW.action = 'download_image')
+EXECUTE FUNCTION count_theme_download();
+
+-- Results per (status, priority), so that job_states.counts() never scans
+-- image_requests. The trigger below only appends +1/-1 rows to
+-- job_state_deltas, which takes no row locks, so concurrent transitions can
+-- never deadlock on counters. fold_job_state_deltas() moves the deltas into
+-- job_state_counts; only one session folds at a time.
+CREATE TABLE job_state_counts (
     status TEXT NOT NULL,
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    priority SMALLINT NOT NULL,
+    count BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (status, priority)
 );
+
+CREATE TABLE job_state_deltas (
+    status TEXT NOT NULL,
+    priority SMALLINT NOT NULL,
+    delta SMALLINT NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION count_job_states() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO job_state_deltas (status, priority, delta) VALUES (OLD.status, OLD.priority, -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO job_state_deltas (status, priority, delta) VALUES (NEW.status, NEW.priority, 1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER image_requests_count_job_states
+AFTER INSERT OR DELETE ON image_requests
+FOR EACH ROW EXECUTE FUNCTION count_job_states();
+
+CREATE TRIGGER image_requests_count_job_state_changes
+AFTER UPDATE OF status, priority ON image_requests
+FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status OR OLD.priority IS DISTINCT FROM NEW.priority)
+EXECUTE FUNCTION count_job_states();
+
+-- Adds the pending deltas to job_state_counts. Returns at once while another
+-- session is folding or reconciling.
+CREATE OR REPLACE PROCEDURE fold_job_state_deltas() AS $$
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('job_state_counts')) THEN
+        RETURN;
+    END IF;
+    WITH folded AS (
+        DELETE FROM job_state_deltas RETURNING status, priority, delta
+    )
+    INSERT INTO job_state_counts (status, priority, count)
+    SELECT status, priority, SUM(delta) FROM folded GROUP BY status, priority
+    ON CONFLICT (status, priority) DO UPDATE
+    SET count = job_state_counts.count + EXCLUDED.count;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Rebuilds job_state_counts after changes that skip row triggers, such as
+-- dropping partitions. Transitions wait on the lock while it runs.
+CREATE OR REPLACE PROCEDURE reconcile_job_state_counts() AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('job_state_counts'));
+    LOCK TABLE job_state_deltas IN EXCLUSIVE MODE;
+    DELETE FROM job_state_deltas;
+    DELETE FROM job_state_counts;
+    INSERT INTO job_state_counts (status, priority, count)
+    SELECT status, priority, COUNT(*)
+    FROM image_requests
+    GROUP BY status, priority;
+END;
+$$ LANGUAGE plpgsql;